@@ -0,0 +1,349 @@
+"""
+Measures the throughput of sweeps over a synthetic source with a known
+native resolution.
+
+Usage:
+    bench.py [options]
+
+Options:
+    --cpus=LIST             Worker counts to test. [default: 1,2,4]
+    --frames=LIST           Frame counts to test. [default: 1,4]
+    --heights=LIST          Height ranges to test as start:stop[:step], separated
+                            by commas. [default: 600:841:4,400:1081:2]
+    --modes=LIST            Execution modes to test. [default: process,thread]
+    --backends=LIST         Tester backends to test. [default: avisynth]
+    --batch                 Score runs of heights in one pass with the numpy backend.
+    --luma                  Compare the luma plane instead of RGB frames.
+    --sample=SPEC           Estimate the errors from a "grid:STEP" or
+                            "tiles:FRACTION[:SIZE]" sample of every frame.
+    --prune=MARGIN          Stop comparisons that exceed the best error of their
+                            tester and frame by this relative margin. Small
+                            margins can hide shallow dips.
+    --search=MODE           "full" or "adaptive". [default: full]
+    --native=HEIGHT         Native height of the source. [default: 720]
+    --size=WxH              Size the source is upscaled to. [default: 1920x1080]
+    --repeat=N              Runs of every configuration. [default: 1]
+    --stand-in              Use the pure-Python stand-in even if AviSynth is available.
+    -o PATH --output=PATH   Append the report as a single line of JSON to PATH
+                            instead of writing it to stdout.
+    -v --verbose            Write the sweep logs to stderr.
+
+Every configuration runs in a process of its own, so peak memory and warm
+caches do not carry over between configurations. The stand-in is used
+automatically where AviSynth cannot be loaded.
+"""
+import os
+import sys
+import json
+import time
+import pickle
+import shutil
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+
+import docopt
+
+from blures import synthetic
+
+if os.environ.get("BLURES_STAND_IN"):
+    synthetic.install()
+else:
+    # The bindings announce the library they load on stdout, which carries the report.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        import avisynth
+    except (ImportError, OSError):
+        os.environ["BLURES_STAND_IN"] = "1"
+        synthetic.install()
+    finally:
+        sys.stdout = stdout
+
+from blures.worker import Executor
+from blures.testers import Tester
+from blures.pool import POOLS
+from blures.compare import parse_sample
+from detect import analyse
+
+
+class MeasuredPool(object):
+    """
+    Counts the bytes pickled through the queues of a pool and the latency of
+    every task, from the start of its clip lookup until the main process
+    collects its result.
+    """
+
+    def _measure(self):
+        self.serialized = self.worker_class is multiprocessing.Process
+        self.ipc_bytes = {"commands": 0, "results": 0}
+        self.latencies = []
+        self.frames = 0
+
+    def send(self, no, command):
+        if self.serialized:
+            self.ipc_bytes["commands"] += len(pickle.dumps(command, pickle.HIGHEST_PROTOCOL))
+        super(MeasuredPool, self).send(no, command)
+
+    def collect(self, timeout=0, max_batch=None, sweep=None):
+        messages = super(MeasuredPool, self).collect(timeout, max_batch, sweep)
+        now = time.time()
+        for message in messages:
+            if self.serialized:
+                self.ipc_bytes["results"] += len(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+            if message[0] == "result":
+                r_time, timings = message[3][7:9]
+                self.latencies.append(sum(timings.values()) + max(0.0, now - r_time))
+                self.frames += 1
+            elif message[0] == "sampled":
+                r_time, timings = message[3][7:9]
+                self.latencies.append(sum(timings.values()) + max(0.0, now - r_time))
+            elif message[0] == "pruned":
+                r_time, timings = message[3][6:8]
+                self.latencies.append(sum(timings.values()) + max(0.0, now - r_time))
+            elif message[0] == "batch":
+                for r_time, timings in (result[6:8] for result in message[3]):
+                    self.latencies.append(sum(timings.values()) + max(0.0, now - r_time))
+        return messages
+
+
+def measured_pool(mode, *args):
+    base = POOLS[mode]
+    pool = type("Measured%s" % base.__name__, (MeasuredPool, base), {})(*args)
+    pool._measure()
+    return pool
+
+
+def peak_rss(pid=None):
+    """
+    Returns the peak resident set size of a process in bytes or None if it
+    cannot be determined.
+    """
+    pid = pid or os.getpid()
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process(pid).memory_info()
+    return getattr(info, "peak_wset", info.rss)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values)-1, int(round(p / 100. * (len(values)-1))))]
+
+
+def run_case(conn, avsfile, native, case, verbose):
+    """
+    Runs a single configuration and sends its measurements through conn.
+    """
+    sys.stdout = sys.stderr if verbose else open(os.devnull, "w")
+    try:
+        heights = range(*(int(i) for i in case["heights"].split(":")))
+        app = Executor(avsfile, heights, range(case["frames"]), cpus=case["cpus"], search=case["search"],
+                       mode=case["mode"], backend=case["backend"], batch=case["batch"],
+                       luma=case["luma"], sample=case["sample"], prune=case["prune"])
+        vi = app.clip.get_video_info()
+        pool = measured_pool(case["mode"], avsfile, case["cpus"], (vi.width, vi.height), app.clip_cache, None,
+                             app.luma)
+        app.pool = pool
+
+        scores = dict((name, {}) for name in app.testers)
+        start = time.time()
+        first = None
+        try:
+            for record in app.stream():
+                if first is None:
+                    first = time.time()
+                scores[record.tester].setdefault(record.height, []).append(record.score)
+            wall = time.time() - start
+            workers = [peak_rss(process.pid) for process in pool.processes.values() if hasattr(process, "pid")]
+        finally:
+            pool.shutdown()
+
+        tasks = app.stats["results"]
+        phases = {}
+        for histograms in app.timings.testers.values():
+            for phase, histogram in histograms.items():
+                phases[phase] = phases.get(phase, 0.0) + histogram.total
+        testers = analyse(scores, app.threshold)
+
+        result = dict(case)
+        result.update({
+            "tasks": tasks,
+            "estimated": app.stats["estimated"],
+            "pruned": app.stats["pruned"],
+            "wall": wall,
+            "startup": (first or time.time()) - start,
+            "tasks_per_second": tasks / max(wall, 1e-6),
+            "latency": {
+                "mean": sum(pool.latencies) / max(len(pool.latencies), 1),
+                "p50": percentile(pool.latencies, 50),
+                "p90": percentile(pool.latencies, 90),
+                "p99": percentile(pool.latencies, 99),
+                "max": max(pool.latencies or [0.0]),
+            },
+            "phases": dict((phase, total / max(tasks, 1)) for phase, total in phases.items()),
+            "peak_rss": {"main": peak_rss(), "workers": workers},
+            "ipc_bytes": pool.ipc_bytes,
+            "shm_bytes": pool.frames * vi.width * vi.height * (1 if app.luma else 3),
+            "candidates": dict((name, tester["candidates"]) for name, tester in testers.items()),
+            "native_found": sorted(name for name, tester in testers.items() if native in tester["candidates"]),
+        })
+        conn.send(result)
+    except Exception as e:
+        import traceback
+        traceback.print_exc(file=sys.stderr)
+        conn.send({"error": str(e) or e.__class__.__name__})
+    finally:
+        conn.close()
+
+
+def measure(avsfile, native, case, verbose=False):
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=run_case, args=(sender, avsfile, native, case, verbose))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {"error": "The benchmark process died with exit code %s" % process.exitcode}
+    process.join()
+
+    if "error" in result:
+        failed = dict(case)
+        failed.update(result)
+        return failed
+    return result
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe(result):
+    name = "%(mode)s %(backend)s cpus=%(cpus)d frames=%(frames)d heights=%(heights)s" % result
+    if "error" in result:
+        return "%s: failed: %s" % (name, result["error"])
+
+    rss = (result["peak_rss"]["main"] or 0) + sum(rss or 0 for rss in result["peak_rss"]["workers"])
+    return "%s: %d tasks, %.1f/s, p50 %.1fms, p99 %.1fms, rss %.0fMB, ipc %.1fKB%s" % (
+        name, result["tasks"], result["tasks_per_second"], result["latency"]["p50"]*1000,
+        result["latency"]["p99"]*1000, rss / 2.**20, sum(result["ipc_bytes"].values()) / 1024.,
+        "" if result["native_found"] else ", native height missed"
+    )
+
+
+def run(argv=None):
+    vars = docopt.docopt(__doc__, argv)
+    try:
+        cpus = [int(c) for c in vars["--cpus"].split(",")]
+        frames = [int(f) for f in vars["--frames"].split(",")]
+        heights = vars["--heights"].split(",")
+        for height in heights:
+            range(*(int(i) for i in height.split(":")))
+        native = int(vars["--native"])
+        size = tuple(int(s) for s in vars["--size"].split("x"))
+        repeat = int(vars["--repeat"])
+        prune = float(vars["--prune"]) if vars["--prune"] else None
+    except (ValueError, TypeError):
+        sys.stderr.write("Invalid cpu counts, frame counts, height ranges, native height, size, repeat or margin.\n")
+        return 2
+
+    if vars["--sample"]:
+        try:
+            parse_sample(vars["--sample"])
+        except ValueError as e:
+            sys.stderr.write("%s\n" % e)
+            return 2
+        if vars["--batch"]:
+            sys.stderr.write("--sample cannot be combined with --batch.\n")
+            return 2
+
+    if prune is not None and (prune < 0 or vars["--batch"]):
+        sys.stderr.write("--prune needs a margin of at least 0 and cannot be combined with --batch.\n")
+        return 2
+
+    modes = vars["--modes"].split(",")
+    backends = vars["--backends"].split(",")
+    if len(size) != 2 or vars["--search"] not in ("full", "adaptive") or any(mode not in POOLS for mode in modes) \
+            or any(backend not in Tester.backends for backend in backends):
+        sys.stderr.write(__doc__)
+        return 2
+
+    if vars["--stand-in"] and not os.environ.get("BLURES_STAND_IN"):
+        # Processes spawned on Windows import this module again and install the stand-in from the environment.
+        os.environ["BLURES_STAND_IN"] = "1"
+        synthetic.install()
+    renderer = "stand-in" if os.environ.get("BLURES_STAND_IN") else "avisynth"
+
+    directory = tempfile.mkdtemp(prefix="blures-bench-")
+    try:
+        avsfile = synthetic.write_script(os.path.join(directory, "synthetic.avs"), native, size, max(frames))
+
+        results = []
+        grid = [(mode, backend, cpu, frame, height) for mode in modes for backend in backends
+                for cpu in cpus for frame in frames for height in heights]
+        for mode, backend, cpu, frame, height in grid:
+            for i in range(repeat):
+                case = {
+                    "mode": mode,
+                    "backend": backend,
+                    "cpus": cpu,
+                    "frames": frame,
+                    "heights": height,
+                    "search": vars["--search"],
+                    "batch": vars["--batch"] and backend == "numpy",
+                    "luma": vars["--luma"],
+                    "sample": vars["--sample"],
+                    "prune": prune,
+                    "run": i,
+                }
+                result = measure(avsfile, native, case, vars["--verbose"])
+                sys.stderr.write("[Bench] %s\n" % describe(result))
+                results.append(result)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": revision(),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "renderer": renderer,
+        "source": {"native": native, "size": list(size)},
+        "results": results,
+    }
+
+    if vars["--output"]:
+        with open(vars["--output"], "a") as f:
+            f.write(json.dumps(report, sort_keys=True) + "\n")
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+    if any("error" in result for result in results):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,193 @@
+"""
+asyncio front-end for sweeps and frame renders.
+
+Python 2 uses the trollius backport of asyncio, so coroutines are written
+with yield From(...) and raise Return(...). Blocking queues and pipes are
+bridged to the event loop by threads that sleep on them, one per sweep and
+one per renderer, so nothing polls on the event loop.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import trollius as asyncio
+from trollius import From, Return
+
+from blures.worker import Executor
+from blures.store import ResultStore
+from blures.tk_avisynth import AvisynthThread
+
+
+def wrap_future(future, loop=None):
+    """
+    Returns an asyncio future that follows a TkFuture. Cancelling the
+    asyncio future also cancels the TkFuture.
+    """
+    loop = loop or asyncio.get_event_loop()
+    result = asyncio.Future(loop=loop)
+
+    def _copy(fut):
+        if result.done():
+            return
+        if fut.is_error():
+            result.set_exception(fut.error)
+        else:
+            result.set_result(fut.result)
+
+    def _cancel(res):
+        if res.cancelled():
+            future.cancel()
+
+    future.add_callback(lambda fut: loop.call_soon_threadsafe(_copy, fut))
+    result.add_done_callback(_cancel)
+    return result
+
+
+class AsyncRenderer(object):
+    """
+    Awaitable frame renders on a dedicated AvisynthThread.
+    """
+
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.thread = AvisynthThread(None)
+        self.thread.start()
+
+    @asyncio.coroutine
+    def load(self, avs):
+        clip = yield From(wrap_future(self.thread.load(avs), self.loop))
+        raise Return(clip)
+
+    @asyncio.coroutine
+    def get_frame(self, clip, n):
+        image = yield From(wrap_future(self.thread.get_frame(clip, n), self.loop))
+        raise Return(image)
+
+    @asyncio.coroutine
+    def get_tester_frame(self, clip, tester, height, n):
+        image = yield From(wrap_future(self.thread.get_tester_frame(clip, tester, height, n), self.loop))
+        raise Return(image)
+
+
+class ResultStream(object):
+    """
+    Asynchronous iterator over the results of a sweep.
+
+    The loop callback of the executor runs on a thread of its own, which
+    blocks on the result queue of the workers. Cancelling a task that waits
+    on the stream stops the sweep. SQLite connections only work on the
+    thread that opened them, so the store of an executor passed in directly
+    must be opened on that thread. sweep() takes care of this.
+
+        stream = yield From(sweep(avsfile, heights, frames))
+        while True:
+            result = yield From(stream.next())
+            if result is None:
+                break
+    """
+
+    def __init__(self, executor, images=False, poll=.5, loop=None):
+        self.executor = executor
+        self.images = images
+        self.poll = poll
+        self.loop = loop or asyncio.get_event_loop()
+
+        self._thread = ThreadPoolExecutor(1)
+        self._store = None
+        self._loopcb = None
+        self._stop = None
+        self._running = True
+        self._closed = False
+        self.ready = deque()
+
+    def _collect(self, record):
+        if record.image is not None:
+            record = record._replace(image=record.image.to_image() if self.images else None)
+        self.ready.append(record)
+
+    def _call(self, func, *args):
+        # Cancelling the caller must not cancel the call, the sweep is
+        # stopped on the same thread once the call returned.
+        return asyncio.shield(self.loop.run_in_executor(self._thread, func, *args), loop=self.loop)
+
+    @asyncio.coroutine
+    def start(self):
+        """
+        Renders the references and starts the workers.
+        """
+        if self._loopcb is None:
+            try:
+                self._loopcb, self._stop = yield From(self._call(self.executor.test))
+            except asyncio.CancelledError:
+                self.close()
+                raise
+
+    @asyncio.coroutine
+    def next(self):
+        """
+        :return: The next Result or None once the sweep is finished.
+        """
+        yield From(self.start())
+
+        while not self.ready:
+            if not self._running or self._closed:
+                self.close()
+                raise Return(None)
+
+            try:
+                self._running = yield From(self._call(self._loopcb, self._collect, self.poll, 256, True))
+            except asyncio.CancelledError:
+                self.close()
+                raise
+
+        raise Return(self.ready.popleft())
+
+    @asyncio.coroutine
+    def collect(self):
+        """
+        :return: A list of all remaining results.
+        """
+        results = []
+        while True:
+            result = yield From(self.next())
+            if result is None:
+                raise Return(results)
+            results.append(result)
+
+    def close(self):
+        """
+        Stops the sweep once the running loop callback returned.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        def _stop():
+            if self._stop is not None:
+                self._stop()
+            if self._store is not None:
+                self._store.close()
+        self._thread.submit(_stop)
+        self._thread.shutdown(wait=False)
+
+
+@asyncio.coroutine
+def sweep(*args, **kwargs):
+    """
+    Creates an Executor without blocking the event loop and returns a
+    started ResultStream of its sweep. Takes the arguments of Executor and
+    the images, poll and loop arguments of ResultStream.
+    """
+    options = dict((key, kwargs.pop(key)) for key in ("images", "poll", "loop") if key in kwargs)
+    stream = ResultStream(None, **options)
+
+    # The script environment and the store of the executor are only used from the thread of the stream.
+    # A store opened by the caller is opened again on that thread.
+    def create():
+        store = kwargs.get("store")
+        if store is not None:
+            stream._store = kwargs["store"] = ResultStore(store.path, store.commit_every)
+        return Executor(*args, **kwargs)
+
+    stream.executor = yield From(stream._call(create))
+    yield From(stream.start())
+    raise Return(stream)
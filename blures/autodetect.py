@@ -1,8 +1,9 @@
+import os
 import multiprocessing
 
 from Tkinter import *
 from ttk import *
-from tkMessageBox import showerror
+from tkMessageBox import showerror, askyesno
 
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2TkAgg
@@ -11,63 +12,10 @@ import matplotlib.animation as animation
 from blures.worker import Executor
 from blures.testers import Tester
 from blures.widgets import ImageViewer
-
-
-def detect(heights, results, thresh):
-    import numpy as np
-    def is_outlier(points):
-        """
-        Returns a boolean array with True if points are outliers and False
-        otherwise.
-
-        Parameters:
-        -----------
-            points : An numobservations by numdimensions array of observations
-            thresh : The modified z-score to use as a threshold. Observations with
-                a modified z-score (based on the median absolute deviation) greater
-                than this value will be classified as outliers.
-
-        Returns:
-        --------
-            mask : A numobservations-length boolean array.
-
-        References:
-        ----------
-            Boris Iglewicz and David Hoaglin (1993), "Volume 16: How to Detect and
-            Handle Outliers", The ASQC Basic References in Quality Control:
-            Statistical Techniques, Edward F. Mykytka, Ph.D., Editor.
-        """
-        if len(points.shape) == 1:
-            points = points[:,None]
-        median = np.median(points, axis=0)
-        diff = np.sum((points - median)**2, axis=-1)
-        diff = np.sqrt(diff)
-        med_abs_deviation = np.median(diff)
-
-        modified_z_score = 0.6745 * diff / med_abs_deviation
-
-        return modified_z_score > thresh
-
-    results = np.array(results)
-    mask = is_outlier(results)
-    outliers = np.array([results, np.arange(len(results), dtype=np.uint16)]).T[mask]
-    ibefore = None
-    for val, i in outliers:
-        if ibefore is None:
-            ibefore = (i, val)
-            continue
-
-        if i - ibefore[0] > 1:
-            ibefore = (i, val)
-            continue
-
-        if ibefore[1] < 0:
-            ibefore = (i, val)
-            continue
-
-        yield heights[int(ibefore[0])]
-
-        ibefore = (i, val)
+from blures.futures import Task
+from blures.detection import detect, slopes
+from blures.store import ResultStore, cache_dir, script_key
+from blures.checkpoint import Checkpoint
 
 
 class Autodetector(Toplevel, object):
@@ -79,8 +27,13 @@ class Autodetector(Toplevel, object):
 
         self.title("Resolution Autodetector")
         self.iconbitmap("data/br.ico")
+        self.protocol("WM_DELETE_WINDOW", self.close)
 
         self.executor = None
+        self.store = ResultStore()
+        self.luma = False
+        self.preview = None
+        self.preview_clip = None
 
         _data = Frame(self)
         _settings = Frame(_data)
@@ -89,7 +42,7 @@ class Autodetector(Toplevel, object):
         except NotImplementedError:
             cCpu = 1
 
-        Label(_settings, text="Processes").grid(row=0, column=0)
+        Label(_settings, text="Workers").grid(row=0, column=0)
         self.cpu_count = cCpu
         if cCpu > 1:
             self.cpu_sel = Combobox(_settings, state="readonly")
@@ -111,11 +64,23 @@ class Autodetector(Toplevel, object):
         Entry(_settings, textvariable=self.from_).grid(row=2, column=1, sticky="news")
         Entry(_settings, textvariable=self.to).grid(row=3, column=1, sticky="news")
 
+        Label(_settings, text="Mode").grid(row=4, column=0)
+        self.mode = Combobox(_settings, state="readonly")
+        self.mode["values"] = ("thread", "process")
+        self.mode.set("thread")
+        self.mode.grid(row=4, column=1, sticky="news")
+
+        Label(_settings, text="Compare").grid(row=5, column=0)
+        self.planes = Combobox(_settings, state="readonly")
+        self.planes["values"] = ("rgb", "luma")
+        self.planes.set("rgb")
+        self.planes.grid(row=5, column=1, sticky="news")
+
         self.proc = Button(_settings, text="Detect", command=self.start_detect)
-        self.proc.grid(row=4, column=0, columnspan=2)
+        self.proc.grid(row=6, column=0, columnspan=2)
 
         self.progress = Progressbar(_settings)
-        self.progress.grid(row=5, column=0, columnspan=2, sticky="news")
+        self.progress.grid(row=7, column=0, columnspan=2, sticky="news")
 
         _settings.grid_columnconfigure(1, weight=1)
         _settings.pack(side="top", padx=5, pady=5, fill="y")
@@ -161,6 +126,38 @@ class Autodetector(Toplevel, object):
 
         self.reset_data()
 
+    def close(self):
+        if self.executor is not None:
+            self.executor[1]()
+            self.executor = None
+        self.destroy()
+
+    def checkpoint_path(self):
+        return os.path.join(cache_dir(), "%s.checkpoint.json" % script_key(self.filename))
+
+    def resume(self):
+        """
+        Offers to resume the last sweep of the script if it was interrupted.
+
+        :return: The resumed executor or None.
+        """
+        path = self.checkpoint_path()
+        if not os.path.exists(path):
+            return None
+
+        try:
+            complete = Checkpoint(path).load()[3]
+        except (ValueError, KeyError):
+            return None
+        if complete or not askyesno("Resume", "Resume the interrupted sweep?", master=self):
+            return None
+
+        try:
+            return Executor.resume(path, keep_warm=True, store=self.store)
+        except (ValueError, OSError, IOError) as e:
+            showerror("Resume failed", str(e), master=self)
+            return None
+
     def find(self):
         try:
             thresh = float(self.thresh.get())
@@ -171,7 +168,7 @@ class Autodetector(Toplevel, object):
         self.values.delete(0, "end")
 
         for name, tester in Tester.testers.items():
-            heights, delta = self.derivative[name]
+            heights, delta = self.update_curves(name)[1]
             for outlier in detect(heights, delta, thresh):
                 res = self.all_frames[(outlier, name)]
                 self.values.insert("end", ("%d@%s | %.2f%%"%(outlier, name, 100*res)))
@@ -184,7 +181,7 @@ class Autodetector(Toplevel, object):
             self.master.open_tab(tester, height)
 
     def reset_data(self):
-        self.d_val = {}
+        self.scores = dict((name, {}) for name in Tester.testers)
         self.all_frames = {}
 
     def reset_plots(self, min_x=400, max_x=1080):
@@ -194,12 +191,12 @@ class Autodetector(Toplevel, object):
         self.derivative_data.set_title("Similarity [d/dx]")
         self.derivative_data.grid()
         self.derivative_data.set_xlabel("Height")
-        self.derivative_data.set_ylabel("Similarity Delta")
+        self.derivative_data.set_ylabel("Error Delta")
 
         self.normal_data.set_title("Similarity [Actual Values]")
         self.normal_data.grid()
         self.normal_data.set_xlabel("Height")
-        self.normal_data.set_ylabel("Similarity")
+        self.normal_data.set_ylabel("Error")
 
         self.derivative_plots = {}
         self.normal_plots = {}
@@ -213,9 +210,7 @@ class Autodetector(Toplevel, object):
             self.normal_plots[name], = self.normal_data.plot([], [], c=tester.color, marker="x", label=name, linewidth=0)
 
         self.derivative_data.set_xlim([min_x, max_x])
-        self.derivative_data.set_ylim([-0.1, +0.1])
         self.normal_data.set_xlim([min_x, max_x])
-        self.normal_data.set_ylim([.55, .75])
 
         self.derivative_data.legend(handles=list(self.derivative_plots.values()), loc='upper left', bbox_to_anchor=(0, 1))
         self.normal_data.legend(handles=list(self.normal_plots.values()), loc='upper left', bbox_to_anchor=(0, 1))
@@ -227,6 +222,11 @@ class Autodetector(Toplevel, object):
             self.proc["text"] = "Detect"
             return
 
+        executor = self.resume()
+        if executor is not None:
+            self.run(executor)
+            return
+
         cpus = int(self.cpu_sel.get())
 
         raw_ar = self.ar.get().split(":")
@@ -252,15 +252,25 @@ class Autodetector(Toplevel, object):
             showerror("Invalid data", "Invalid end frame", master=self)
             return
 
+        executor = Executor(self.filename, range(from_, to+1, 2), self.framecb(), aspect_ratio=ar, cpus=cpus, keep_warm=True,
+                            store=self.store, checkpoint=self.checkpoint_path(), mode=self.mode.get(),
+                            luma=self.planes.get() == "luma")
+        self.run(executor)
+
+    def run(self, executor):
+        heights = executor.hstep
+        self.luma = executor.luma
+        self.aspect_ratio = executor.aspect_ratio
+        if self.luma and self.preview_clip is None:
+            self.preview_clip = self.master.avisynth.load(self.filename)
         self.proc["text"] = "Stop"
-        self.progress["max"] = len(xrange(from_, to+1, 2))*len(Tester.testers)
         self.progress["value"] = 0
 
-        self.reset_plots(from_, to)
+        self.reset_plots(min(heights), max(heights))
         self.reset_data()
 
-        executor = Executor(self.filename, range(from_, to+1, 2), self.framecb(), aspect_ratio=ar, cpus=cpus)
         cb, stop = executor.test()
+        self.progress["max"] = executor.stats["planned"]
 
         self.after(1, self.sync)
         self.executor = (executor, stop, cb)
@@ -274,15 +284,31 @@ class Autodetector(Toplevel, object):
             return
 
         if self.executor[2](self.new_result):
-            self.after(10, self.sync)
+            # Adaptive and sampled sweeps plan more tasks as results arrive.
+            self.progress["max"] = self.executor[0].stats["planned"]
+            self.after(50, self.sync)
             return
 
+        self.executor[1]()
         self.executor = None
         self.proc["text"] = "Detect"
 
+    def update_curves(self, name):
+        """
+        Recomputes the errors and deltas of a tester from its results sorted
+        by height, as results of neighbouring heights arrive out of order.
+        """
+        results = self.scores[name]
+        heights = sorted(results)
+        errors = [sum(results[h]) / len(results[h]) for h in heights]
+        self.normal[name] = heights, errors
+        self.derivative[name] = slopes(heights, errors)
+        return self.normal[name], self.derivative[name]
+
     def _update_lines(self, num):
         plts = []
         for name, tester in Tester.testers.items():
+            self.update_curves(name)
             norm_heights, norm_result = self.normal[name]
             self.normal_plots[name].set_data(norm_heights, norm_result)
             plts.append(self.normal_plots[name])
@@ -290,25 +316,37 @@ class Autodetector(Toplevel, object):
             deri_heights, deri_result = self.derivative[name]
             self.derivative_plots[name].set_data(deri_heights, deri_result)
             plts.append(self.derivative_plots[name])
-        return plts
 
-    def new_result(self, tester, width, height, frame, result, image):
-        norm_heights, norm_result = self.normal[tester]
+        for axes in (self.normal_data, self.derivative_data):
+            axes.relim()
+            axes.autoscale_view(scalex=False)
+        return plts
 
-        norm_heights.append(height)
-        norm_result.append(result)
+    def update_preview(self, tester, height, frame):
+        """
+        Luma sweeps only render the Y8 plane, so the preview renders the
+        candidate again in RGB on the AvisynthThread of the main window.
+        Results arriving while a preview is rendered are not shown.
+        """
+        if self.preview is not None and not self.preview.is_done():
+            return
+        self.preview = self._render_preview(tester, height, frame)
+        self.preview.set_lowlevel()
 
-        if tester in self.d_val:
-            deri_heights, deri_result = self.derivative[tester]
-            deri_heights.append(height)
-            deri_result.append(result - self.d_val[tester])
-        self.d_val[tester] = result
+    @Task
+    def _render_preview(self, tester, height, frame):
+        clip = yield self.preview_clip
+        self.viewer.image = yield self.master.avisynth.get_tester_frame(clip, tester, height, frame, self.aspect_ratio)
 
-        self.figure.canvas.draw()
-        self.stats.show()
+    def new_result(self, tester, width, height, frame, result, image):
+        self.scores[tester].setdefault(height, []).append(result)
 
         self.progress["value"] = int(self.progress["value"])+1
 
-        self.viewer.image = image
+        if image is not None:
+            if self.luma:
+                self.update_preview(tester, height, frame)
+            else:
+                self.viewer.image = image.to_image()
 
         self.add_list(tester, height, result)
\ No newline at end of file
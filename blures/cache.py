@@ -0,0 +1,52 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, factory):
+        """
+        Returns the cached value for the key or creates it by calling factory.
+        """
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = factory()
+            while len(self._data) >= self.size > 0:
+                self._data.popitem(last=False)
+            if self.size <= 0:
+                return value
+        else:
+            self.hits += 1
+
+        self._data[key] = value
+        return value
+
+    def clear(self):
+        self._data.clear()
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / float(total)
+
+    def __str__(self):
+        return "%d hits, %d misses (%.1f%%), %d/%d entries" % (
+            self.hits, self.misses, self.hit_rate()*100, len(self), self.size
+        )
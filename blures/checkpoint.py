@@ -0,0 +1,63 @@
+import os
+import json
+import time
+
+
+class Checkpoint(object):
+    """
+    The configuration, completed results and outstanding tasks of a sweep,
+    stored as JSON.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path, interval=30):
+        self.path = path
+        self.interval = interval
+        self.last_save = time.time()
+
+    def due(self):
+        return time.time() - self.last_save >= self.interval
+
+    def save(self, config, results, pending, complete=False):
+        """
+        Writes the checkpoint. The previous checkpoint is only replaced once
+        the new one has been written completely.
+
+        :param config:   The keyword arguments of the Executor.
+        :param results:  A dictionary mapping tasks to (result, channels).
+        :param pending:  The tasks that have not been completed.
+        """
+        data = {
+            "version": self.VERSION,
+            "config": config,
+            "results": [list(task) + [result, list(channels)] for task, (result, channels) in results.items()],
+            "pending": [list(task) for task in pending],
+            "complete": complete,
+        }
+
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f)
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(tmp, self.path)
+        self.last_save = time.time()
+
+    def load(self):
+        """
+        :return: A tuple of the config, the results, the pending tasks and whether the sweep was complete.
+        """
+        with open(self.path, "r") as f:
+            data = json.load(f)
+
+        if data.get("version") != self.VERSION:
+            raise ValueError("Unsupported checkpoint version: %r" % data.get("version"))
+
+        results = {}
+        for tester, width, height, frame, result, channels in data["results"]:
+            results[(tester, width, height, frame)] = (result, tuple(channels))
+
+        pending = [tuple(task) for task in data["pending"]]
+        return data["config"], results, pending, data["complete"]
@@ -0,0 +1,331 @@
+import numpy as np
+
+
+class Comparator(object):
+    """
+    Compares candidate frames against a single reference frame.
+
+    The error is the root mean squared difference relative to the full
+    8 bit range, reported per channel and for all channels combined.
+    Differences are accumulated as integers in a scratch buffer that is
+    allocated once per reference or shared between comparators of the
+    same frame size.
+    """
+
+    metric = "rms"
+
+    # Rows per band of a bounded comparison.
+    BAND = 16
+
+    def __init__(self, reference, scratch=None):
+        reference = np.asarray(reference, dtype=np.uint8)
+        if reference.ndim == 2:
+            reference = reference[:, :, None]
+
+        self.reference = np.ascontiguousarray(reference)
+        self.shape = self.reference.shape
+        self.pixels = self.shape[0] * self.shape[1]
+
+        if scratch is None:
+            scratch = self.create_scratch(self.shape)
+        self._diff = scratch.reshape(self.shape)
+        self._flat = self._diff.reshape(-1, self.shape[2])
+        self._bands = None
+
+    @staticmethod
+    def create_scratch(shape):
+        return np.empty(shape, dtype=np.int32)
+
+    def _as_frame(self, candidate):
+        candidate = np.asarray(candidate)
+        if candidate.ndim == 2:
+            candidate = candidate[:, :, None]
+
+        if candidate.shape != self.shape:
+            raise ValueError("Frame has shape %r, expected %r" % (candidate.shape, self.shape))
+        return candidate
+
+    def sse(self, candidate):
+        """
+        Returns the sum of squared differences for each channel.
+        """
+        candidate = self._as_frame(candidate)
+        np.subtract(candidate, self.reference, out=self._diff, dtype=np.int32)
+        np.multiply(self._diff, self._diff, out=self._diff)
+        return self._flat.sum(axis=0, dtype=np.int64)
+
+    def error(self, sse):
+        """
+        Converts per channel squared sums into (combined, per_channel) errors.
+        """
+        sse = np.asarray(sse, dtype=np.float64)
+        channels = np.sqrt(sse / self.pixels) / 255.
+        combined = np.sqrt(sse.sum(axis=-1) / (self.pixels * self.shape[2])) / 255.
+        return combined, channels
+
+    def compare(self, candidate):
+        """
+        Compares a single frame.
+
+        :param candidate:  A uint8 array with the shape of the reference.
+        :return: A tuple of the combined error and an array with the error of each channel.
+        """
+        combined, channels = self.error(self.sse(candidate))
+        return float(combined), channels
+
+    @property
+    def bands(self):
+        """
+        The (start, stop) rows of the bands of a bounded comparison, the
+        bands with the most gradient energy in the reference first.
+        Rescaling errors concentrate around edges and fine texture, so
+        these bands raise the error of a poor candidate the fastest.
+        """
+        if self._bands is None:
+            gray = self.reference.astype(np.float32).sum(axis=2)
+            detail = np.zeros(self.shape[0])
+            detail[1:] += (np.diff(gray, axis=0)**2).sum(axis=1)
+            detail += (np.diff(gray, axis=1)**2).sum(axis=1)
+
+            starts = np.arange(0, self.shape[0], self.BAND)
+            order = np.argsort(-np.add.reduceat(detail, starts), kind="mergesort")
+            self._bands = [(int(starts[i]), int(min(starts[i] + self.BAND, self.shape[0]))) for i in order]
+        return self._bands
+
+    def compare_bounded(self, bands, bound, out=None):
+        """
+        Compares a frame band by band and stops as soon as its error
+        exceeds bound.
+
+        :param bands:  An iterable of the candidate rows of every band in
+                       the order of Comparator.bands.
+        :param bound:  The combined error at which to stop.
+        :param out:    A frame the compared bands are copied into.
+        :return: A tuple of the combined error, an array with the error of
+                 each channel and whether the whole frame was compared. The
+                 errors of an incomplete comparison are lower bounds.
+        """
+        limit = (bound * 255.)**2 * self.pixels * self.shape[2]
+        sse = np.zeros(self.shape[2], dtype=np.int64)
+        bands = iter(bands)
+        for i, (start, stop) in enumerate(self.bands):
+            band = np.asarray(next(bands)).reshape((stop - start,) + self.shape[1:])
+            if out is not None:
+                np.copyto(out[start:stop], band)
+                band = out[start:stop]
+
+            diff = self._diff[start:stop]
+            np.subtract(band, self.reference[start:stop], out=diff, dtype=np.int32)
+            np.multiply(diff, diff, out=diff)
+            sse += diff.reshape(-1, self.shape[2]).sum(axis=0, dtype=np.int64)
+            if sse.sum() > limit and i < len(self.bands) - 1:
+                combined, channels = self.error(sse)
+                return float(combined), channels, False
+
+        combined, channels = self.error(sse)
+        return float(combined), channels, True
+
+    def compare_stack(self, candidates):
+        """
+        Compares a stack of frames in a single call.
+
+        :param candidates: A uint8 array of shape (n, height, width[, channels]).
+        :return: A tuple of an array of n combined errors and an (n, channels) array.
+        """
+        stack = np.asarray(candidates)
+        if stack.ndim == 3:
+            stack = stack[..., None]
+        if stack.shape[1:] != self.shape:
+            raise ValueError("Frames have shape %r, expected %r" % (stack.shape[1:], self.shape))
+
+        diff = np.subtract(stack, self.reference, dtype=np.int32)
+        np.multiply(diff, diff, out=diff)
+        return self.error(diff.reshape(len(stack), -1, self.shape[2]).sum(axis=1, dtype=np.int64))
+
+
+
+# The two-sided 95% quantile of the normal distribution.
+CONFIDENCE = 1.96
+
+
+class RegionSample(object):
+    """
+    A fixed subset of the pixels of a frame and an estimator of the squared
+    error of the whole frame from it.
+
+    The sampled pixels are grouped into units, whole rows or tiles, and the
+    units into strata. Every stratum is treated as a simple random sample
+    of its units, the total is estimated as the sum of the stratum sizes
+    times the mean unit total with the usual stratified variance. All
+    candidates of a frame are measured on the same pixels, so their
+    differences are far more accurate than the intervals suggest.
+    """
+
+    # Samples of whole rows and columns can be rendered without the rest of the frame.
+    rows = columns = None
+
+    def __init__(self, shape, index, offsets, scale, strata):
+        """
+        :param index:    The flat indices of the sampled pixels, ordered by unit.
+        :param offsets:  The position of the first pixel of every unit in index.
+        :param scale:    The factor from the sampled pixels of a unit to its total.
+        :param strata:   A list of (number of units in the frame, slice of the sampled units).
+        """
+        self.shape = tuple(shape)
+        self.index = index
+        self.offsets = offsets
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.strata = strata
+
+    @property
+    def fraction(self):
+        return len(self.index) / float(self.shape[0] * self.shape[1])
+
+    def take(self, frame):
+        """
+        Gathers the sampled pixels of a frame into an array of shape (pixels, channels).
+        """
+        return np.asarray(frame).reshape(-1, self.shape[2])[self.index]
+
+    def estimate(self, squared):
+        """
+        :param squared:  The squared differences of the sampled pixels.
+        :return: The estimated sum of squared differences of each channel of
+                 the frame and the standard error of their combined sum.
+        """
+        units = np.add.reduceat(squared, self.offsets, axis=0, dtype=np.int64) * self.scale[:, None]
+        totals = np.zeros(self.shape[2])
+        variance = 0.
+        for population, units_slice in self.strata:
+            values = units[units_slice]
+            sampled = len(values)
+            totals += population * values.mean(axis=0)
+            if 1 < sampled < population:
+                variance += population**2 * (1. - sampled/float(population)) * values.sum(axis=1).var(ddof=1) / sampled
+        return totals, np.sqrt(variance)
+
+
+class GridSample(RegionSample):
+    """
+    Every step-th column of every step-th row. The rows are the units of
+    a single stratum, the systematic sample is treated as a random one.
+    """
+
+    def __init__(self, shape, step):
+        height, width = shape[:2]
+        self.step = step
+        rows = np.arange(min(step // 2, height-1), height, step)
+        columns = np.arange(min(step // 2, width-1), width, step)
+
+        index = (rows[:, None] * width + columns).ravel()
+        offsets = np.arange(len(rows)) * len(columns)
+        scale = np.full(len(rows), width / float(len(columns)))
+        super(GridSample, self).__init__(shape, index, offsets, scale, [(height, slice(None))])
+        self.rows = rows
+        self.columns = columns
+
+
+class TileSample(RegionSample):
+    """
+    Square tiles drawn with a bias towards detail.
+
+    Tiles are split into four strata by the gradient energy of the
+    reference and allocated to them by Neyman allocation, with the mean
+    detail of a stratum as a proxy of its spread. The draw is seeded,
+    every worker samples the same tiles of a frame.
+    """
+
+    STRATA = 4
+
+    def __init__(self, reference, fraction, tile=32, seed=0):
+        reference = np.asarray(reference)
+        height, width = reference.shape[:2]
+        self.tile = tile
+
+        ys = np.arange(0, height, tile)
+        xs = np.arange(0, width, tile)
+        gray = reference.reshape(height, width, -1).astype(np.float32).sum(axis=2)
+        detail = np.zeros((height, width), dtype=np.float32)
+        detail[1:] += np.diff(gray, axis=0)**2
+        detail[:, 1:] += np.diff(gray, axis=1)**2
+        areas = np.outer(np.diff(np.append(ys, height)), np.diff(np.append(xs, width)))
+        detail = (np.add.reduceat(np.add.reduceat(detail, ys, axis=0), xs, axis=1) / areas).ravel()
+
+        order = np.argsort(detail, kind="mergesort")
+        groups = [group for group in np.array_split(order, self.STRATA) if len(group)]
+        weights = np.array([len(group) * (detail[group].mean() + 1.) for group in groups])
+        wanted = max(int(np.ceil(fraction * len(detail))), 2 * len(groups))
+        counts = np.minimum(np.maximum(np.round(wanted * weights / weights.sum()).astype(np.intp), 2),
+                            [len(group) for group in groups])
+
+        random = np.random.RandomState(seed)
+        index, offsets, strata = [], [], []
+        position = 0
+        for group, count in zip(groups, counts):
+            chosen = np.sort(random.choice(group, count, replace=False))
+            strata.append((len(group), slice(len(offsets), len(offsets) + count)))
+            for tile_no in chosen:
+                y, x = ys[tile_no // len(xs)], xs[tile_no % len(xs)]
+                pixels = (np.arange(y, min(y+tile, height))[:, None] * width
+                          + np.arange(x, min(x+tile, width))).ravel()
+                offsets.append(position)
+                index.append(pixels)
+                position += len(pixels)
+
+        super(TileSample, self).__init__(reference.shape, np.concatenate(index), np.array(offsets),
+                                         np.ones(len(offsets)), strata)
+
+
+def parse_sample(spec):
+    """
+    Parses "grid:STEP" or "tiles:FRACTION[:SIZE]" into a kind and its parameters.
+    """
+    kind, _, params = spec.partition(":")
+    try:
+        if kind == "grid":
+            step = int(params)
+            if step >= 1:
+                return kind, (step,)
+        elif kind == "tiles":
+            values = params.split(":")
+            fraction, tile = float(values[0]), int(values[1]) if len(values) > 1 else 32
+            if 0 < fraction <= 1 and tile >= 1 and len(values) <= 2:
+                return kind, (fraction, tile)
+    except ValueError:
+        pass
+    raise ValueError("Invalid sample: %s" % spec)
+
+
+def create_sample(spec, reference):
+    kind, params = parse_sample(spec)
+    if kind == "grid":
+        return GridSample(np.asarray(reference).shape, *params)
+    return TileSample(reference, *params)
+
+
+class SampledComparator(object):
+    """
+    Estimates the error of a Comparator from a RegionSample of the frame.
+    """
+
+    def __init__(self, comparator, sample):
+        self.comparator = comparator
+        self.sample = sample
+        self.reference = sample.take(comparator.reference)
+        self._diff = np.empty(self.reference.shape, dtype=np.int32)
+
+    def compare(self, pixels, confidence=CONFIDENCE):
+        """
+        :param pixels:  The sampled pixels of a candidate, as returned by RegionSample.take.
+        :return: A tuple of the estimated combined error, an array with the
+                 estimated error of each channel and the (low, high) bounds
+                 of the combined error.
+        """
+        np.subtract(pixels, self.reference, out=self._diff, dtype=np.int32)
+        np.multiply(self._diff, self._diff, out=self._diff)
+        totals, error = self.sample.estimate(self._diff)
+
+        combined, channels = self.comparator.error(totals)
+        values = self.comparator.pixels * self.comparator.shape[2]
+        bounds = np.sqrt(np.maximum(totals.sum() + np.array([-confidence, confidence]) * error, 0) / values) / 255.
+        return float(combined), channels, (float(bounds[0]), float(bounds[1]))
@@ -0,0 +1,76 @@
+import numpy as np
+
+
+def is_outlier(points, thresh):
+    """
+    Returns a boolean array with True if points are outliers and False
+    otherwise.
+
+    Parameters:
+    -----------
+        points : An numobservations by numdimensions array of observations
+        thresh : The modified z-score to use as a threshold. Observations with
+            a modified z-score (based on the median absolute deviation) greater
+            than this value will be classified as outliers.
+
+    Returns:
+    --------
+        mask : A numobservations-length boolean array.
+
+    References:
+    ----------
+        Boris Iglewicz and David Hoaglin (1993), "Volume 16: How to Detect and
+        Handle Outliers", The ASQC Basic References in Quality Control:
+        Statistical Techniques, Edward F. Mykytka, Ph.D., Editor.
+    """
+    if len(points.shape) == 1:
+        points = points[:,None]
+    median = np.median(points, axis=0)
+    diff = np.sum((points - median)**2, axis=-1)
+    diff = np.sqrt(diff)
+    med_abs_deviation = np.median(diff)
+
+    modified_z_score = 0.6745 * diff / med_abs_deviation
+
+    return modified_z_score > thresh
+
+
+def slopes(heights, errors):
+    """
+    Returns the heights and the error deltas to the previous height, divided
+    by the spacing of the heights so that unevenly spaced sweeps compare.
+
+    :param heights:  The sorted heights.
+    :param errors:   The errors at these heights.
+    """
+    return heights[1:], [(b-a) / float(y-x) for x, y, a, b in zip(heights, heights[1:], errors, errors[1:])]
+
+
+def detect(heights, results, thresh):
+    """
+    Yields the heights at which the error dips.
+
+    :param heights:  The heights of the deltas.
+    :param results:  The error deltas to the previous height.
+    :param thresh:   The modified z-score threshold.
+    """
+    results = np.array(results)
+    mask = is_outlier(results, thresh)
+    outliers = np.array([results, np.arange(len(results), dtype=np.uint16)]).T[mask]
+    ibefore = None
+    for val, i in outliers:
+        if ibefore is None:
+            ibefore = (i, val)
+            continue
+
+        if i - ibefore[0] > 1:
+            ibefore = (i, val)
+            continue
+
+        if ibefore[1] > 0:
+            ibefore = (i, val)
+            continue
+
+        yield heights[int(ibefore[0])]
+
+        ibefore = (i, val)
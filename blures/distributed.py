@@ -0,0 +1,613 @@
+import time
+import Queue
+import socket
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+from blures.testers import Tester
+from blures.compare import Comparator
+from blures.cache import LRUCache
+from blures.scheduler import Scheduler
+from blures.store import script_key
+from blures.worker import ScaleWorker, Executor, Result
+
+
+def parse_address(value, default_host=""):
+    """
+    Parses HOST:PORT. The host may be omitted.
+    """
+    host, _, port = value.rpartition(":")
+    return host or default_host, int(port)
+
+
+class Broker(object):
+    """
+    The task plan of a distributed sweep.
+
+    Nodes lease runs of tasks and return their results. A lease that is
+    neither completed nor renewed in time is revoked and its tasks are
+    handed out again, so slow or dead nodes cannot stall the sweep. Results
+    of revoked leases are still accepted if nobody else delivered them first.
+    """
+
+    def __init__(self, config, workers=1, lease_time=60, run_length=8, max_failures=3):
+        self.config = config
+        self.lease_time = lease_time
+        self.run_length = run_length
+        self.max_failures = max_failures
+
+        self.lock = threading.Lock()
+        self.scheduler = Scheduler([], workers, run_length)
+        self.leases = {}
+        self.planned = set()
+        self.completed = set()
+        self.failures = {}
+        self.failed = []
+        self.nodes = set()
+        self.results = Queue.Queue()
+
+        self.sealed = False
+        self.closed = False
+        self.expired = 0
+        self._lease = 0
+
+    def add(self, tasks):
+        with self.lock:
+            fresh = [task for task in tasks if task not in self.planned]
+            self.planned.update(fresh)
+            self.scheduler.add(fresh)
+
+    def seal(self):
+        """
+        Marks the plan as complete. Nodes are released once all of its tasks are done.
+        """
+        self.sealed = True
+
+    def close(self):
+        """
+        Releases all nodes, whether the plan is complete or not.
+        """
+        self.closed = True
+        with self.lock:
+            self.scheduler.clear()
+
+    def finished(self):
+        with self.lock:
+            return self.closed or (self.sealed and not self.leases and not len(self.scheduler))
+
+    def expire(self):
+        """
+        Revokes all leases that ran out and requeues their tasks.
+        """
+        now = time.time()
+        with self.lock:
+            for lease_id, (worker, deadline, tasks) in list(self.leases.items()):
+                if deadline < now:
+                    del self.leases[lease_id]
+                    self.expired += 1
+                    self._requeue(tasks)
+
+    def _requeue(self, tasks):
+        self.scheduler.add([task for task in tasks if task not in self.completed])
+
+    def hello(self, worker):
+        self.nodes.add(worker)
+        return self.config
+
+    def lease(self, worker):
+        """
+        :return: A tuple of the lease id, the leased tasks and whether the sweep is finished.
+                 The tasks are empty if there is currently no work for the worker.
+        """
+        self.expire()
+        with self.lock:
+            if self.closed:
+                return None, [], True
+
+            run = self.scheduler.next_run(worker, self.run_length)
+            if run is None:
+                finished = self.sealed and not self.leases
+                return None, [], finished
+
+            self._lease += 1
+            self.leases[self._lease] = (worker, time.time() + self.lease_time, run)
+            return self._lease, run, False
+
+    def renew(self, lease_id):
+        """
+        Extends a lease. Returns False if it was already revoked.
+        """
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None or self.closed:
+                return False
+            self.leases[lease_id] = (lease[0], time.time() + self.lease_time, lease[2])
+            return True
+
+    def complete(self, worker, lease_id, results):
+        """
+        Accepts the results of a lease. Tasks of the lease without a result are requeued.
+
+        :param results: A list of (tester, width, height, frame, result, channels) tuples.
+        :return: The number of results that were not delivered before.
+        """
+        accepted = 0
+        with self.lock:
+            for result in results:
+                task = tuple(result[:4])
+                if task in self.completed or task not in self.planned:
+                    continue
+                self.completed.add(task)
+                self.results.put(tuple(result) + (worker,))
+                accepted += 1
+
+            lease = self.leases.pop(lease_id, None)
+            if lease is not None and not self.closed:
+                self._requeue(lease[2])
+        return accepted
+
+    def fail(self, lease_id, task, message):
+        """
+        Reports a task that could not be rendered. Tasks failing on
+        max_failures attempts are dropped from the plan.
+        """
+        task = tuple(task)
+        with self.lock:
+            self.failures[task] = self.failures.get(task, 0) + 1
+            if self.failures[task] >= self.max_failures and task not in self.completed:
+                self.completed.add(task)
+                self.failed.append((task, message))
+        return self.failures[task]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "nodes": len(self.nodes),
+                "leases": len(self.leases),
+                "expired": self.expired,
+                "failed": len(self.failed),
+                "pending": len(self.scheduler),
+            }
+
+
+class BrokerClient(object):
+    """
+    Calls the methods of a remote Broker over a single connection.
+    """
+
+    exposed = ("hello", "lease", "renew", "complete", "fail")
+
+    def __init__(self, address, authkey):
+        self.connection = Client(address, authkey=authkey)
+
+    def call(self, method, *args):
+        self.connection.send((method, args))
+        status, value = self.connection.recv()
+        if status != "ok":
+            raise RuntimeError("The coordinator failed to handle %s: %s" % (method, value))
+        return value
+
+    def __getattr__(self, name):
+        if name not in self.exposed:
+            raise AttributeError(name)
+        return lambda *args: self.call(name, *args)
+
+    def close(self):
+        self.connection.close()
+
+
+class Coordinator(Executor):
+    """
+    Owns the task plan of a sweep and serves it to RemoteWorkers on other hosts.
+
+    Nodes connect over authenticated TCP connections, render the
+    reference frames themselves and only send back the scores, so results
+    are reported without an image. The coordinator does not need AviSynth.
+    """
+
+    def __init__(self, avsfile, heights, frames, aspect_ratio=(16,9), address=("", 0), authkey=None,
+                 lease_time=60, run_length=8, search="full", coarse_step=16, threshold=5, store=None,
+                 backend="avisynth", luma=False):
+        if not authkey:
+            raise ValueError("The coordinator needs an authkey shared with the nodes.")
+        if backend not in Tester.backends:
+            raise ValueError("Unknown tester backend: %s" % backend)
+
+        self.avsfile = avsfile
+        self.backend = backend
+        self.testers = Tester.backends[backend]
+        self.batch = False
+        self.luma = luma
+        self.fstep = list(frames)
+        self.hstep = list(heights)
+        self.aspect_ratio = aspect_ratio
+
+        self.search = search
+        self.coarse_step = coarse_step
+        self.threshold = threshold
+        self.adaptive = None
+        self.store = store
+
+        self.address = address
+        self.authkey = authkey
+        self.lease_time = lease_time
+        self.run_length = run_length
+        self.cpus = None
+
+        self.broker = None
+        self._listener = None
+        self._connections = set()
+        self._closed = False
+
+    def config(self):
+        return {
+            "avsfile": self.avsfile,
+            "heights": self.hstep,
+            "frames": self.fstep,
+            "aspect_ratio": list(self.aspect_ratio),
+            "search": self.search,
+            "coarse_step": self.coarse_step,
+            "threshold": self.threshold,
+            "lease_time": self.lease_time,
+            "backend": self.backend,
+            "luma": self.luma,
+        }
+
+    def serve(self, broker):
+        """
+        Accepts node connections in a background thread.
+        """
+        self._listener = Listener(self.address, authkey=self.authkey)
+        self.address = self._listener.address
+        self._connections = set()
+        self._closed = False
+
+        thread = threading.Thread(target=self._serve, args=(broker,))
+        thread.daemon = True
+        thread.start()
+        print("[Main] Coordinating on %s:%d" % self.address)
+
+    def _serve(self, broker):
+        while not self._closed:
+            try:
+                connection = self._listener.accept()
+            except Exception:
+                continue
+
+            if self._closed:
+                connection.close()
+                break
+
+            self._connections.add(connection)
+            thread = threading.Thread(target=self._handle, args=(broker, connection))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, broker, connection):
+        try:
+            while True:
+                method, args = connection.recv()
+                if method not in BrokerClient.exposed:
+                    connection.send(("error", "Unknown method %r" % (method,)))
+                    continue
+
+                try:
+                    connection.send(("ok", getattr(broker, method)(*args)))
+                except Exception as e:
+                    connection.send(("error", repr(e)))
+        except (EOFError, IOError):
+            pass
+        finally:
+            self._connections.discard(connection)
+            connection.close()
+
+    def shutdown(self):
+        """
+        Stops accepting nodes and drops the connections of all nodes.
+        """
+        if self._listener is None or self._closed:
+            return
+        self._closed = True
+
+        host, port = self.address
+        if host in ("", "0.0.0.0"):
+            host = "127.0.0.1"
+        try:
+            Client((host, port), authkey=self.authkey).close()
+        except (socket.error, EOFError, IOError):
+            pass
+        self._listener.close()
+
+        for connection in list(self._connections):
+            connection.close()
+
+    def test(self):
+        frames = list(self.get_frames(self.fstep))
+        script = script_key(self.avsfile)
+
+        config = self.config()
+        config["script"] = script
+        broker = self.broker = Broker(config, lease_time=self.lease_time, run_length=self.run_length)
+
+        cached = {}
+        replay = deque()
+        if self.store is not None:
+            params = dict((name, self.result_key(tester)) for name, tester in self.testers.items())
+            cached = self.store.load(script, params)
+
+        def submit(tasks):
+            fresh = []
+            for task in tasks:
+                if task in broker.planned:
+                    continue
+                if task in cached:
+                    broker.planned.add(task)
+                    replay.append(task)
+                else:
+                    fresh.append(task)
+            broker.add(fresh)
+
+        submit(self.get_plan(frames))
+        adaptive = self.adaptive
+        if adaptive is None:
+            broker.seal()
+
+        stats = self.stats = {
+            "results": 0,
+            "cached": 0,
+            "planned": len(broker.planned),
+            "throughput": 0.0,
+        }
+        stats.update(broker.stats())
+
+        self.serve(broker)
+        starttime = time.time()
+        stopped = [False]
+        given_up = [0]
+
+        def advance(tester, height, frame, result):
+            if adaptive is None:
+                return
+
+            refine = adaptive.add(tester, height, frame, result)
+            if refine:
+                submit(self.get_task(*task) for task in refine)
+            if adaptive.finished():
+                broker.seal()
+
+        def skip_failed():
+            """
+            Counts the tasks that were given up as done for the adaptive
+            search, so their tester and frame can still be refined.
+            """
+            failed = broker.failed[given_up[0]:]
+            given_up[0] += len(failed)
+            if adaptive is None:
+                return
+
+            for (tester, width, height, frame), message in failed:
+                refine = adaptive.skip(tester, height, frame)
+                if refine:
+                    submit(self.get_task(*task) for task in refine)
+            if adaptive.finished():
+                broker.seal()
+
+        def deliver(record, item_update, detailed):
+            stats["results"] += 1
+            if detailed:
+                item_update(record)
+            else:
+                item_update(record.tester, record.width, record.height, record.frame, record.score, None)
+            advance(record.tester, record.height, record.frame, record.score)
+
+        def done():
+            # finished() goes first: a result delivered between the two checks
+            # would otherwise be left in the queue.
+            return not replay and broker.finished() and broker.results.empty()
+
+        def test_loopcb(item_update, timeout=0, max_batch=256, detailed=False):
+            """
+            Handles all results that are ready, waiting up to timeout seconds
+            for the first one. Returns False once the sweep is complete or stopped.
+
+            :param detailed:  Call item_update with a single Result.
+            """
+            if stopped[0]:
+                return False
+
+            while replay:
+                task = replay.popleft()
+                result, channels = cached[task]
+                stats["cached"] += 1
+                deliver(Result(*(task + (result, channels, None, None, None, None))), item_update, detailed)
+
+            broker.expire()
+            count = 0
+            try:
+                block = timeout != 0
+                while count < max_batch:
+                    tester, width, height, frame, result, channels, node = broker.results.get(block, timeout)
+                    block = False
+                    count += 1
+
+                    elapsed = time.time() - starttime
+                    self.print_result(tester, width, height, frame, result, elapsed, node)
+                    if self.store is not None:
+                        self.store.add(script, params[tester], tester, width, height, frame, result, channels)
+                    deliver(Result(tester, width, height, frame, result, channels, elapsed, node, None, None),
+                            item_update, detailed)
+            except Queue.Empty:
+                pass
+            skip_failed()
+
+            stats["planned"] = len(broker.planned)
+            stats.update(broker.stats())
+            elapsed = time.time() - starttime
+            if elapsed > 0:
+                stats["throughput"] = stats["results"] / elapsed
+
+            if done():
+                for task, message in broker.failed:
+                    print("[Main] Gave up on %s %dx%d@%d: %s" % (task + (message,)))
+                print("[Main] %(results)d results from %(nodes)d nodes, %(throughput).2f/s, "
+                      "%(expired)d leases expired" % stats)
+                if self.store is not None:
+                    self.store.flush()
+                return False
+            return True
+
+        def stop():
+            """
+            Releases all nodes and stops serving the plan.
+            """
+            if stopped[0]:
+                return
+            stopped[0] = True
+
+            broker.close()
+            if self.store is not None:
+                self.store.flush()
+            self.shutdown()
+
+        return test_loopcb, stop
+
+    def print_result(self, t, w, h, f, p, c, n):
+        print("[Result] %s\t%dx%d\t%d\t%.4f%%\t%.2fsecs\t%s" % (t, w, h, f, p*100, c, n))
+
+
+class RemoteWorker(ScaleWorker):
+    """
+    Pulls leased tasks from a coordinator and pushes their scores back.
+    """
+
+    def __init__(self, address, authkey, name, poll=1.0, clip_cache=64):
+        self.address = address
+        self.authkey = authkey
+        self.name = name
+        self.poll = poll
+        self.clips = LRUCache(clip_cache)
+        self.frames = {}
+
+    def write_message(self, message):
+        print("[%s] %s" % (self.name, message))
+
+    @classmethod
+    def start(cls, address, authkey, name, avsfile=None, poll=1.0, clip_cache=64):
+        worker = cls(address, authkey, name, poll, clip_cache)
+        worker.run(avsfile)
+
+    def run(self, avsfile=None):
+        """
+        Serves leases until the coordinator reports that the sweep is finished.
+
+        :param avsfile:  The local path of the script. Defaults to the path used by the coordinator.
+        """
+        broker = BrokerClient(self.address, self.authkey)
+        try:
+            self.work(broker, avsfile)
+        except (socket.error, EOFError, IOError):
+            self.write_message("Disconnected from the coordinator")
+        finally:
+            broker.close()
+
+    def work(self, broker, avsfile):
+        import avisynth
+
+        config = broker.hello(self.name)
+        avsfile = avsfile or config["avsfile"]
+        if script_key(avsfile) != config["script"]:
+            self.write_message("%s differs from the script of the coordinator" % avsfile)
+            return
+
+        self.write_message("Initializing avisynth")
+        self.testers = Tester.backends[config.get("backend", "avisynth")]
+        self.env = avisynth.AVS_ScriptEnvironment(3)
+        for tester in self.testers.values():
+            tester.init(self.env)
+        luma = config.get("luma", False)
+        self.clip = self.load_clip(self.env, avsfile, luma)
+
+        vi = self.clip.get_video_info()
+        self.scratch = Comparator.create_scratch((vi.height, vi.width, 1 if luma else 3))
+        lease_time = config["lease_time"]
+
+        while True:
+            lease_id, tasks, finished = broker.lease(self.name)
+            if not tasks:
+                if finished:
+                    break
+                time.sleep(self.poll)
+                continue
+
+            leased = time.time()
+            results = []
+            for task in tasks:
+                try:
+                    results.append(self.process_task(*task))
+                except avisynth.AvisynthError as e:
+                    self.write_message("Error in %dx%d@%d: %s" % (task[1], task[2], task[3], e))
+                    broker.fail(lease_id, task, str(e))
+
+                if time.time() - leased > lease_time / 2.:
+                    if not broker.renew(lease_id):
+                        break
+                    leased = time.time()
+
+            broker.complete(self.name, lease_id, results)
+
+        self.write_message("Clip cache: %s" % self.clips)
+
+    def get_reference(self, frame):
+        comparator = self.frames.get(frame)
+        if comparator is None:
+            reference = np.array(self.get_frame_array(self.env, self.clip, frame))
+            comparator = self.frames[frame] = Comparator(reference, self.scratch)
+        return comparator
+
+    def process_task(self, tester, width, height, frame):
+        tester_inst = self.testers[tester]
+        test_clip = self.clips.get(
+            (tester_inst.backend, tester, width, height),
+            lambda: tester_inst.test(self.env, self.clip, (width, height))
+        )
+
+        reference = self.get_reference(frame)
+        if tester_inst.backend == "numpy":
+            data = test_clip.rescale(reference.reference)
+        else:
+            data = self.get_frame_array(self.env, test_clip, frame)
+        result, channels = reference.compare(data)
+        return tester, width, height, frame, result, tuple(channels.tolist())
+
+
+def run_node(address, authkey, cpus=None, avsfile=None, poll=1.0, clip_cache=64):
+    """
+    Runs one RemoteWorker per CPU until the coordinator finishes the sweep.
+
+    :return: The number of workers that did not exit cleanly.
+    """
+    if cpus is None:
+        try:
+            cpus = multiprocessing.cpu_count()
+        except NotImplementedError:
+            cpus = 1
+
+    host = socket.gethostname()
+    processes = []
+    for no in range(cpus):
+        name = "%s/%d" % (host, no)
+        process = multiprocessing.Process(
+            target=RemoteWorker.start,
+            args=(address, authkey, name, avsfile, poll, clip_cache)
+        )
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    for process in processes:
+        process.join()
+    return sum(1 for process in processes if process.exitcode != 0)
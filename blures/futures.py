@@ -3,6 +3,10 @@ import functools
 import traceback
 
 
+class CancelledError(Exception):
+    pass
+
+
 class TkFuture(object):
 
     def __init__(self):
@@ -31,6 +35,13 @@ class TkFuture(object):
         self.result = result
         self._call_cbs(self.result_cb)
 
+    def cancel(self):
+        """
+        Fails the future with a CancelledError. Queued commands of a
+        cancelled future are skipped.
+        """
+        self.set_error(CancelledError())
+
     def add_callback(self, cb):
         self.add_res_cb(cb)
         self.add_err_cb(cb)
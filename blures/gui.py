@@ -9,6 +9,7 @@ from blures.futures import Task, TaskCallback
 from blures.tk_avisynth import AvisynthThread
 from blures.widgets import ImageViewer
 from blures.autodetect import Autodetector
+from blures.pool import shutdown_all
 
 
 class FrameViewer(Notebook, object):
@@ -323,6 +324,7 @@ class Application(Tk, object):
         self.editor.open_tab(tester, height)
 
     def quit(self):
+        shutdown_all()
         self.destroy()
 
 
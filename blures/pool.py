@@ -0,0 +1,252 @@
+import os
+import Queue
+import atexit
+import threading
+import multiprocessing
+
+from blures.sharedmem import FrameRing
+
+
+class WorkerPool(object):
+    """
+    A set of ScaleWorker processes that stay alive between sweeps.
+
+    Every worker loads the script once and then parks on its input queue
+    until the next sweep arrives. All workers report into a single result
+    queue so the main process can block on all of them at once. Pools returned by WorkerPool.shared are
+    reused by every Executor working on the same script.
+
+    A pool runs one sweep at a time. The sweep claims the pool and releases
+    it when it is done, an Executor that finds the pool claimed starts a
+    private one instead.
+    """
+
+    _shared = {}
+    _lock = threading.Lock()
+    queue_class = staticmethod(multiprocessing.Queue)
+    worker_class = multiprocessing.Process
+
+    def __init__(self, avsfile, cpus, size, clip_cache=64, profile=None, luma=False):
+        """
+        :param profile:  None or a tuple of the profile mode and the directory
+                         the workers write their statistics into.
+        :param luma:     Load the luma plane of the script instead of RGB frames.
+        """
+        self.avsfile = avsfile
+        self.cpus = cpus
+        self.size = size
+        self.clip_cache = clip_cache
+        self.profile = profile
+        self.luma = luma
+        self.config = self._config(avsfile, cpus, size, clip_cache, profile, luma)
+
+        self.ring = None
+        self.processes = {}
+        self.in_queues = {}
+        self.results = None
+        self.cancelled = multiprocessing.Value("l", 0)
+        self._sweep = 0
+        self.owner = None
+        self.retired = False
+
+    @staticmethod
+    def _config(avsfile, cpus, size, clip_cache, profile=None, luma=False):
+        try:
+            mtime = os.path.getmtime(avsfile)
+        except OSError:
+            mtime = None
+        return cpus, tuple(size), clip_cache, profile, luma, mtime
+
+    @classmethod
+    def shared(cls, avsfile, cpus, size, clip_cache=64, profile=None, luma=False):
+        """
+        Returns the warm pool of the script, creating it if necessary. A
+        pool with another configuration is replaced, if a sweep still runs
+        on it, it is shut down once that sweep releases it.
+        """
+        key = os.path.abspath(avsfile)
+        with cls._lock:
+            pool = cls._shared.get(key)
+            if pool is not None and pool.config != cls._config(avsfile, cpus, size, clip_cache, profile, luma):
+                del cls._shared[key]
+                if pool.owner is None:
+                    pool.shutdown()
+                else:
+                    pool.retired = True
+                pool = None
+
+            if pool is None:
+                pool = cls._shared[key] = cls(avsfile, cpus, size, clip_cache, profile, luma)
+            return pool
+
+    @classmethod
+    def shutdown_all(cls):
+        for pool in list(cls._shared.values()):
+            pool.shutdown()
+
+    @property
+    def workers(self):
+        return sorted(self.processes)
+
+    def start(self):
+        """
+        Starts all workers that are not running.
+        """
+        from blures.worker import ScaleWorker
+
+        if self.ring is None:
+            self.ring = FrameRing(self.size[0], self.size[1], 2*self.cpus, 1 if self.luma else 3)
+        if self.results is None:
+            self.results = self.queue_class()
+
+        for no in range(self.cpus):
+            process = self.processes.get(no)
+            if process is not None and process.is_alive():
+                continue
+
+            print("[Main] Starting worker %d" % no)
+            self.in_queues[no] = self.queue_class()
+            process = self.worker_class(
+                target=ScaleWorker.start,
+                args=(
+                    no, self.avsfile, self.in_queues[no], self.results, self.ring,
+                    self.cancelled, self.clip_cache, self.profile, self.luma
+                )
+            )
+            process.daemon = True
+            self.processes[no] = process
+            process.start()
+
+    def claim(self):
+        """
+        Returns the id of a new sweep that owns the pool until it is
+        released, or None while another sweep owns it.
+        """
+        with self._lock:
+            if self.owner is not None or self.retired:
+                return None
+            self._sweep += 1
+            self.owner = self._sweep
+            return self.owner
+
+    def release(self, sweep):
+        """
+        Ends the ownership of a sweep. A retired pool is shut down.
+        """
+        with self._lock:
+            if self.owner != sweep:
+                return
+            self.owner = None
+            retired = self.retired
+        if retired:
+            self.shutdown()
+
+    def cancel(self, sweep):
+        """
+        Makes the workers skip all remaining tasks of the sweep and drops
+        its results that are already waiting in the result queue.
+        """
+        with self.cancelled.get_lock():
+            self.cancelled.value = max(self.cancelled.value, sweep)
+
+        if self.results is None:
+            return
+        for message in self.collect(0):
+            self._drop(message)
+
+    def _drop(self, message):
+        type, worker, msg_sweep, data = message
+        if type == "message":
+            print("[Worker-%d] %s" % (worker, data))
+        elif type == "result":
+            self.ring.release(data[6])
+
+    def send(self, no, command):
+        self.in_queues[no].put(command)
+
+    def is_alive(self, no):
+        return self.processes[no].is_alive()
+
+    def collect(self, timeout=0, max_batch=None, sweep=None):
+        """
+        Returns all messages that are ready, waiting up to timeout seconds
+        for the first one. A timeout of None waits until a message arrives.
+
+        :param sweep:  Only return the messages of this sweep. The late
+                       messages of earlier sweeps are dropped.
+        """
+        messages = []
+        try:
+            if timeout == 0:
+                messages.append(self.results.get_nowait())
+            else:
+                messages.append(self.results.get(timeout=timeout))
+        except Queue.Empty:
+            return messages
+
+        while max_batch is None or len(messages) < max_batch:
+            try:
+                messages.append(self.results.get_nowait())
+            except Queue.Empty:
+                break
+
+        if sweep is None:
+            return messages
+        for message in messages:
+            if message[2] != sweep and message[0] != "message":
+                self._drop(message)
+        return [message for message in messages if message[2] == sweep or message[0] == "message"]
+
+    def shutdown(self, timeout=5):
+        """
+        Stops all workers and releases the shared memory.
+        """
+        for no, process in self.processes.items():
+            if process.is_alive():
+                self.send(no, ("shutdown",))
+
+        for process in self.processes.values():
+            process.join(timeout)
+            if process.is_alive() and hasattr(process, "terminate"):
+                process.terminate()
+
+        self.processes.clear()
+        self.in_queues.clear()
+        self.results = None
+
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+        key = os.path.abspath(self.avsfile)
+        if type(self)._shared.get(key) is self:
+            del type(self)._shared[key]
+
+
+class ThreadPool(WorkerPool):
+    """
+    Runs the ScaleWorkers as threads of the main process.
+
+    Every thread owns its own script environment and clip. AviSynth releases
+    the GIL while it renders, and results are passed through in-process
+    queues without pickling. Starting threads is much cheaper than starting
+    processes, which mostly pays off for short sweeps from the GUI.
+    """
+
+    _shared = {}
+    queue_class = Queue.Queue
+    worker_class = threading.Thread
+
+
+POOLS = {
+    "process": WorkerPool,
+    "thread": ThreadPool,
+}
+
+
+def shutdown_all():
+    for pool in POOLS.values():
+        pool.shutdown_all()
+
+
+atexit.register(shutdown_all)
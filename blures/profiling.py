@@ -0,0 +1,182 @@
+import os
+import sys
+import glob
+import time
+import pstats
+import cProfile
+import threading
+from StringIO import StringIO
+from collections import Counter
+
+
+PROFILE_MODES = ("cprofile", "sample")
+
+
+def categorize(filename, name=""):
+    """
+    Attributes a function to AviSynth, NumPy, waiting or Python glue.
+
+    Calls through ctypes do not show up as functions of their own, their
+    time is accounted to the Python function in avisynth.py that made them.
+    """
+    if filename == "~":
+        filename = name
+    filename = filename.replace("\\", "/")
+
+    if os.path.basename(filename).startswith("avisynth."):
+        return "avisynth"
+    if "numpy" in filename or os.path.basename(filename).startswith("compare."):
+        return "numpy"
+    for marker in ("Queue.py", "queues.py", "threading.py", "synchronize.py", "multiprocessing", "acquire",
+                   "lock", "Lock", "recv", "sleep", "select", "poll"):
+        if marker in filename:
+            return "wait"
+    return "python"
+
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of a single thread at a fixed interval.
+
+    Sampling costs next to nothing between samples, so it can stay enabled
+    for production sweeps. Stacks are stored in the collapsed format of
+    flame graph tools.
+    """
+
+    def __init__(self, interval=.005):
+        self.interval = interval
+        self.samples = Counter()
+        self._ident = None
+        self._root = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def enable(self, root=None):
+        """
+        :param root:  The outermost frame of the sampled stacks. Defaults to
+                      the caller, forked workers still carry the frames of their parent.
+        """
+        self._root = root or sys._getframe(1)
+        self._ident = threading.current_thread().ident
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def disable(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._ident)
+            if frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                if frame is self._root:
+                    break
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def dump_stats(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("%s %d\n" % (stack, count))
+
+
+class WorkerProfiler(object):
+    """
+    Profiles a worker and writes its statistics into a directory.
+
+    Every start of a worker writes a file of its own, so the statistics of
+    restarted workers are kept.
+    """
+
+    def __init__(self, mode, directory, name):
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode: %s" % mode)
+
+        extension = ".prof" if mode == "cprofile" else ".samples"
+        self.mode = mode
+        self.path = os.path.join(directory, "%s-%d-%d%s" % (name, os.getpid(), int(time.time()*1000), extension))
+        self.profiler = cProfile.Profile() if mode == "cprofile" else SamplingProfiler()
+
+    def start(self):
+        if self.mode == "cprofile":
+            self.profiler.enable()
+        else:
+            self.profiler.enable(sys._getframe(1))
+
+    def dump(self):
+        """
+        Writes the statistics collected so far and keeps profiling.
+        """
+        self.profiler.dump_stats(self.path)
+        if self.mode == "cprofile":
+            # Profile.dump_stats disables the profiler.
+            self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+        self.profiler.dump_stats(self.path)
+
+
+def load_samples(paths):
+    samples = Counter()
+    for path in paths:
+        with open(path, "r") as f:
+            for line in f:
+                stack, _, count = line.rstrip("\n").rpartition(" ")
+                if stack:
+                    samples[stack] += int(count)
+    return samples
+
+
+def report(directory, top=15):
+    """
+    Merges the statistics of all workers profiled into a directory.
+
+    :return: A text report with the time per category and the most
+             expensive functions or stacks.
+    """
+    lines = []
+
+    profiles = sorted(glob.glob(os.path.join(directory, "*.prof")))
+    if profiles:
+        stats = pstats.Stats(*profiles)
+        categories = Counter()
+        for (filename, line, name), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+            categories[categorize(filename, name)] += tottime
+
+        total = sum(categories.values()) or 1.0
+        lines.append("cProfile of %d workers, %.2fs total:" % (len(profiles), total))
+        for category, seconds in categories.most_common():
+            lines.append("  %-10s %8.2fs %5.1f%%" % (category, seconds, 100 * seconds / total))
+
+        out = StringIO()
+        stats.stream = out
+        stats.sort_stats("tottime").print_stats(top)
+        lines.append(out.getvalue().strip())
+
+    sampled = sorted(glob.glob(os.path.join(directory, "*.samples")))
+    if sampled:
+        samples = load_samples(sampled)
+        categories = Counter()
+        for stack, count in samples.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            categories[categorize(leaf.split(":", 1)[0], leaf)] += count
+
+        total = sum(samples.values()) or 1
+        lines.append("Samples of %d workers, %d total:" % (len(sampled), total))
+        for category, count in categories.most_common():
+            lines.append("  %-10s %8d %5.1f%%" % (category, count, 100. * count / total))
+        for stack, count in samples.most_common(top):
+            lines.append("  %5.1f%%  %s" % (100. * count / total, stack))
+
+    return "\n".join(lines) if lines else "No profiles in %s" % directory
@@ -0,0 +1,447 @@
+"""
+Descaling and rescaling with NumPy.
+
+An upscale along one axis is a linear map A from the native size to the
+frame size, with the kernel weights of AviSynth's resizers in its rows.
+Descaling solves the least-squares problem A x = y through the normal
+equations (A^T A) x = A^T y. A^T A is banded and positive definite, so it
+is factorised once per size in blocks and solved by block substitution. Both axes
+are separable, a frame is descaled vertically and horizontally and then
+upscaled horizontally and vertically. The upscales compute every output
+pixel on its own, so any subset of rows and columns can be rendered
+without the rest of the frame.
+"""
+import os
+import hashlib
+import threading
+
+import numpy as np
+
+from blures.cache import LRUCache
+from blures.store import cache_dir
+
+
+def bilinear(x):
+    x = np.abs(x)
+    return np.where(x < 1, 1 - x, 0.)
+
+
+bilinear.support = 1
+
+
+def bicubic(b=1/3., c=1/3.):
+    """
+    The Mitchell-Netravali family of cubic kernels used by BicubicResize.
+    """
+    def kernel(x):
+        x = np.abs(x)
+        x2, x3 = x*x, x*x*x
+        near = (12 - 9*b - 6*c)*x3 + (-18 + 12*b + 6*c)*x2 + (6 - 2*b)
+        far = (-b - 6*c)*x3 + (6*b + 30*c)*x2 + (-12*b - 48*c)*x + (8*b + 24*c)
+        return np.where(x < 1, near, np.where(x < 2, far, 0.)) / 6.
+
+    kernel.support = 2
+    return kernel
+
+
+def upscale_matrix(kernel, native, size):
+    """
+    The (size, native) matrix of an upscale with the sampling grid of
+    AviSynth's resizers. Taps beyond the edges are clamped to the edge pixels.
+    """
+    centers = (np.arange(size) + .5) * (native / float(size)) - .5
+    taps = np.floor(centers).astype(np.intp)[:, None] + np.arange(1 - kernel.support, kernel.support + 1)
+    weights = kernel(centers[:, None] - taps)
+    weights /= weights.sum(axis=1)[:, None]
+
+    matrix = np.zeros((size, native))
+    np.add.at(matrix, (np.arange(size)[:, None], np.clip(taps, 0, native-1)), weights)
+    return matrix
+
+
+def banded(matrix):
+    """
+    Compresses the rows of a banded matrix into (indices, weights), both of
+    shape (rows, taps). Rows with fewer non-zero entries are padded with zero weights.
+    """
+    rows, columns = matrix.shape
+    nonzero = matrix != 0
+    first = np.argmax(nonzero, axis=1)
+    last = columns - 1 - np.argmax(nonzero[:, ::-1], axis=1)
+    taps = int((last - first).max()) + 1
+
+    indices = np.minimum(first[:, None] + np.arange(taps), columns-1)
+    weights = matrix[np.arange(rows)[:, None], indices]
+    weights[first[:, None] + np.arange(taps) >= columns] = 0
+    return indices, weights.astype(np.float32)
+
+
+def apply_banded(operator, data, block=16):
+    """
+    Multiplies a banded operator with the rows of data. The rows a block of
+    the operator reads are gathered into a small dense matrix, so every
+    block takes a single matrix product.
+    """
+    indices, weights = operator
+    data = np.asarray(data, dtype=np.float32)
+    out = np.empty((len(indices),) + data.shape[1:], dtype=np.float32)
+    for start in range(0, len(indices), block):
+        rows = indices[start:start+block]
+        used, columns = np.unique(rows, return_inverse=True)
+        dense = np.zeros((len(rows), len(used)), dtype=np.float32)
+        np.add.at(dense, (np.arange(len(rows))[:, None], columns.reshape(rows.shape)), weights[start:start+block])
+        if used[-1] - used[0] + 1 == len(used):
+            np.dot(dense, data[used[0]:used[-1]+1], out=out[start:start+block])
+        else:
+            np.dot(dense, data[used], out=out[start:start+block])
+    return out
+
+
+class AxisRescaler(object):
+    """
+    Descales and upscales along the first axis of a two-dimensional array.
+
+    A native size of at least the frame size can reproduce every frame, its
+    rescale returns the frame unchanged.
+
+    The Cholesky factor L of A^T A is kept in blocks of BLOCK rows: the
+    inverses of its diagonal blocks and the corners of its sub-diagonal
+    blocks that are not zero. A substitution takes one matrix product per
+    block for all columns at once.
+    """
+
+    ARRAYS = ("upscale_indices", "upscale_weights", "transpose_indices", "transpose_weights",
+              "inverses", "couplings")
+    # Part of the names of stored operators. Bumped whenever the arrays change.
+    FORMAT = 2
+
+    # Rows per block of the factor.
+    BLOCK = 16
+
+    def __init__(self, kernel, native, size):
+        self.native = native
+        self.size = size
+        self.exact = native >= size
+        if self.exact:
+            return
+
+        matrix = upscale_matrix(kernel, native, size)
+        self.upscale_indices, self.upscale_weights = banded(matrix)
+        self.transpose_indices, self.transpose_weights = banded(matrix.T)
+
+        # A^T A and its Cholesky factor have the bandwidth of the taps of a row of A.
+        indices = self.upscale_indices
+        weights = np.where(self.upscale_weights != 0, matrix[np.arange(size)[:, None], indices], 0)
+        bandwidth = max(1, int((np.where(weights != 0, indices, 0).max(axis=1) - indices[:, 0]).max()))
+        block = max(self.BLOCK, bandwidth)
+        count = -(-native // block)
+
+        # The diagonal blocks of A^T A and the blocks below them, padded with the identity.
+        diagonal = np.zeros((count, block, block))
+        below = np.zeros((count, block, block))
+        rows, columns = np.broadcast_arrays(indices[:, :, None], indices[:, None, :])
+        products = weights[:, :, None] * weights[:, None, :]
+        same = rows // block == columns // block
+        np.add.at(diagonal, (rows[same] // block, rows[same] % block, columns[same] % block), products[same])
+        lower = rows // block == columns // block + 1
+        np.add.at(below, (rows[lower] // block, rows[lower] % block, columns[lower] % block), products[lower])
+        padding = np.arange(native, count * block)
+        diagonal[padding // block, padding % block, padding % block] = 1
+
+        self.inverses = np.empty((count, block, block), dtype=np.float32)
+        self.couplings = np.zeros((count, bandwidth, bandwidth), dtype=np.float32)
+        inverse = None
+        for k in range(count):
+            normal = diagonal[k]
+            if k:
+                # Only the first rows and last columns of the sub-diagonal block of L are not zero.
+                coupling = below[k].dot(inverse.T)
+                normal = normal - coupling.dot(coupling.T)
+                self.couplings[k] = coupling[:bandwidth, block-bandwidth:]
+            inverse = np.linalg.inv(np.linalg.cholesky(normal))
+            self.inverses[k] = inverse
+
+    @property
+    def bandwidth(self):
+        return self.couplings.shape[1]
+
+    @property
+    def block(self):
+        return self.inverses.shape[1]
+
+    def save(self, path):
+        """
+        Writes the operators to a .npz file. Workers that factorised the same
+        operator concurrently keep the file that was written first.
+        """
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            np.savez(f, **dict((name, getattr(self, name)) for name in self.ARRAYS))
+
+        if os.path.exists(path):
+            os.remove(tmp)
+        else:
+            os.rename(tmp, path)
+
+    @classmethod
+    def load(cls, path, native, size):
+        rescaler = cls.__new__(cls)
+        rescaler.native = native
+        rescaler.size = size
+        rescaler.exact = False
+        with np.load(path) as arrays:
+            for name in cls.ARRAYS:
+                setattr(rescaler, name, arrays[name])
+        return rescaler
+
+    def substitute(self, rhs):
+        """
+        Solves L z = rhs for the Cholesky factor L of A^T A. The result has
+        the padded length of the blocks, the padding is zero.
+        """
+        n, p, b = self.native, self.bandwidth, self.block
+        z = np.zeros((len(self.inverses) * b,) + rhs.shape[1:], dtype=np.float32)
+        z[:n] = rhs
+        for k, inverse in enumerate(self.inverses):
+            start = k * b
+            if k:
+                z[start:start+p] -= self.couplings[k].dot(z[start-p:start])
+            z[start:start+b] = inverse.dot(z[start:start+b])
+        return z
+
+    def solve(self, rhs):
+        """
+        Solves (A^T A) x = rhs by forward and backward substitution.
+        """
+        n, p, b = self.native, self.bandwidth, self.block
+        x = self.substitute(rhs)
+        for k in range(len(self.inverses)-1, -1, -1):
+            start = k * b
+            if k + 1 < len(self.inverses):
+                x[start+b-p:start+b] -= self.couplings[k+1].T.dot(x[start+b:start+b+p])
+            x[start:start+b] = self.inverses[k].T.dot(x[start:start+b])
+        return x[:n]
+
+    def descale(self, data):
+        if self.exact:
+            raise ValueError("Cannot descale %d to %d pixels." % (self.size, self.native))
+        return self.solve(apply_banded((self.transpose_indices, self.transpose_weights), data))
+
+    def upscale(self, data):
+        return apply_banded((self.upscale_indices, self.upscale_weights), data)
+
+    def rescale(self, data):
+        if self.exact:
+            return data
+        return self.upscale(self.descale(data))
+
+    def reduce(self, data):
+        """
+        Descales data or, if the size is exact, returns it unchanged.
+        """
+        if self.exact:
+            return data
+        return self.descale(data)
+
+    def expand(self, data, rows=slice(None)):
+        """
+        Upscales reduced data and returns only the given rows, the others are not computed.
+        """
+        if self.exact:
+            return data[rows]
+        return apply_banded((self.upscale_indices[rows], self.upscale_weights[rows]), data)
+
+    def coefficients(self, data):
+        """
+        Returns L^-1 A^T data. The rescale is an orthogonal projection, so the
+        squared sums of the coefficients equal those of the rescaled data
+        without computing it.
+        """
+        if self.exact:
+            return data
+        return self.substitute(apply_banded((self.transpose_indices, self.transpose_weights), data))[:self.native]
+
+
+# The least number of operators kept in memory, sweeps reserve room for all of theirs.
+OPERATORS = 64
+_operators = LRUCache(OPERATORS)
+# The workers of a ThreadPool share the cache, which is not thread-safe by itself.
+_operators_lock = threading.Lock()
+
+
+def reserve_operators(count):
+    """
+    Sizes the operator cache for a sweep that uses count operators, so none
+    of them is factorised twice.
+    """
+    with _operators_lock:
+        _operators.size = max(OPERATORS, count)
+
+
+def operator_dir():
+    return os.path.join(cache_dir(), "operators")
+
+
+def axis_rescaler(kernel_key, kernel, native, size, directory=None):
+    """
+    Returns the cached AxisRescaler of a kernel and size.
+
+    Operators are kept in memory and on disk so later sweeps do not have to
+    factorise them again.
+
+    :param kernel_key:  A hashable description of the kernel and its parameters.
+    :param directory:   The directory of the stored operators, by default operator_dir().
+    """
+    if directory is None:
+        directory = operator_dir()
+
+    def create():
+        if native >= size:
+            return AxisRescaler(kernel, native, size)
+
+        name = hashlib.sha1(repr((AxisRescaler.FORMAT, kernel_key, native, size)).encode("utf-8")).hexdigest()
+        path = os.path.join(directory, name + ".npz")
+        try:
+            return AxisRescaler.load(path, native, size)
+        except (IOError, OSError, KeyError, ValueError):
+            pass
+
+        rescaler = AxisRescaler(kernel, native, size)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            rescaler.save(path)
+        except (IOError, OSError):
+            pass
+        return rescaler
+
+    key = (kernel_key, native, size)
+    with _operators_lock:
+        if key in _operators:
+            return _operators.get(key, create)
+
+    # Operators are created outside the lock. If two threads create the same one, the first is kept.
+    rescaler = create()
+    with _operators_lock:
+        return _operators.get(key, lambda: rescaler)
+
+
+class Rescaler(object):
+    """
+    Descales frames of one size to a native resolution and upscales them again.
+
+    Unlike a chain of AviSynth filters the intermediate frame is not rounded
+    to 8 bits, the errors differ slightly from those of the plugins.
+    """
+
+    # Part of the keys of stored results. Bumped whenever a change of the rescale changes the scores.
+    VERSION = 3
+
+    def __init__(self, kernel_key, kernel, size, native):
+        self.size = size
+        self.native = native
+        self.vertical = axis_rescaler(kernel_key, kernel, native[1], size[1])
+        self.horizontal = axis_rescaler(kernel_key, kernel, native[0], size[0])
+
+    def widen(self, frame, columns=slice(None)):
+        """
+        Descales a frame along both axes and upscales it horizontally again.
+
+        :return: A float32 array of shape (native height, columns, channels).
+        """
+        frame = np.asarray(frame)
+        height, width = frame.shape[:2]
+        channels = frame[0, 0].size
+
+        data = self.vertical.reduce(frame.reshape(height, width*channels).astype(np.float32))
+        rows = len(data)
+        data = data.reshape(rows, width, channels).swapaxes(0, 1).reshape(width, rows*channels)
+        data = self.horizontal.expand(self.horizontal.reduce(data), columns)
+        return np.ascontiguousarray(data.reshape(len(data), rows, channels).swapaxes(0, 1))
+
+    def heighten(self, data, rows=slice(None)):
+        """
+        Upscales the given rows of a widened frame.
+
+        :return: A uint8 array of shape (rows, columns, channels).
+        """
+        native, columns, channels = data.shape
+        data = self.vertical.expand(data.reshape(native, columns*channels), rows)
+        return np.clip(data + .5, 0, 255).astype(np.uint8).reshape(len(data), columns, channels)
+
+    def rescale(self, frame):
+        """
+        :param frame:  A uint8 array of shape (height, width[, channels]).
+        :return: The rescaled frame as a uint8 array of the same shape.
+        """
+        frame = np.asarray(frame)
+        return self.heighten(self.widen(frame)).reshape(frame.shape)
+
+    def rescale_sample(self, frame, sample):
+        """
+        Returns the pixels of a RegionSample of the rescaled frame. Samples
+        of whole rows and columns only upscale the sampled pixels.
+        """
+        if sample.rows is None:
+            return sample.take(self.rescale(frame))
+        data = self.heighten(self.widen(frame, sample.columns), sample.rows)
+        return data.reshape(-1, data.shape[2])
+
+    def rescale_bands(self, frame, bands):
+        """
+        Returns an iterator over the rescaled rows of every (start, stop)
+        band. Both descales are done at once, the vertical upscale of a
+        band only when it is requested.
+        """
+        data = self.widen(frame)
+        return (self.heighten(data, slice(start, stop)) for start, stop in bands)
+
+
+class BatchEvaluator(object):
+    """
+    Scores many candidate resolutions against a single frame in one pass.
+
+    The squared error of a least-squares rescale is the energy of the frame
+    minus the energy of its projection. Only the coefficients of the
+    projection are computed, no rescaled frame is rendered. Candidates are
+    grouped by height and the vertical pass of a height is shared by all of
+    its widths. The frame is converted and its energy summed once.
+    """
+
+    def __init__(self, frame, directory=None):
+        frame = np.asarray(frame)
+        self.height, self.width = frame.shape[:2]
+        self.channels = frame[0, 0].size
+        self.directory = directory
+
+        self.data = frame.reshape(self.height, self.width*self.channels).astype(np.float32)
+        self.energy = self.sums(self.data)
+
+    def sums(self, data):
+        """
+        Per channel squared sums of an array with interleaved channels.
+        """
+        data = data.reshape(-1, self.channels).astype(np.float64)
+        return np.einsum("ij,ij->j", data, data)
+
+    def evaluate(self, kernel_key, kernel, resolutions):
+        """
+        :param resolutions:  A list of (width, height) tuples.
+        :return: An array of the per channel squared errors of each resolution.
+        """
+        heights = {}
+        for index, (width, height) in enumerate(resolutions):
+            heights.setdefault(height, []).append((index, width))
+
+        sse = np.empty((len(resolutions), self.channels), dtype=np.float64)
+        for height, widths in sorted(heights.items()):
+            vertical = axis_rescaler(kernel_key, kernel, height, self.height, self.directory)
+            coefficients = vertical.coefficients(self.data)
+            rows = len(coefficients)
+            columns = coefficients.reshape(rows, self.width, self.channels).swapaxes(0, 1)
+            columns = columns.reshape(self.width, rows*self.channels)
+
+            for index, width in widths:
+                horizontal = axis_rescaler(kernel_key, kernel, width, self.width, self.directory)
+                sse[index] = np.maximum(self.energy - self.sums(horizontal.coefficients(columns)), 0)
+        return sse
@@ -0,0 +1,128 @@
+import math
+from collections import OrderedDict
+
+
+class Scheduler(object):
+    """
+    Hands out tasks in runs that share a source frame and tester.
+
+    Every (frame, tester) pair is split into one lane of consecutive heights
+    per worker. A worker preferably continues with the same frame and
+    tester, then with its own lane on the next frame, so its tester clips
+    and AviSynth's frame caches stay warm and source frames are read in
+    ascending order.
+    """
+
+    def __init__(self, tasks, workers, run_length=None):
+        self.workers = workers
+        self.run_length = run_length
+        self.runs = OrderedDict()
+
+        self.last = {}
+        self.dispatched = 0
+        self.same_frame = 0
+        self.same_lane = 0
+        self.cold = 0
+        self.tasks = 0
+
+        self.add(tasks)
+
+    def add(self, tasks):
+        """
+        Adds more tasks to the plan.
+        """
+        groups = OrderedDict()
+        for task in tasks:
+            tester, width, height, frame = task
+            groups.setdefault((frame, tester), []).append(task)
+
+        for (frame, tester) in sorted(groups, key=lambda key: key[0]):
+            group = sorted(groups[(frame, tester)], key=lambda task: task[2])
+
+            length = self.run_length
+            if length is None:
+                length = int(math.ceil(len(group) / float(max(self.workers, 1))))
+
+            for lane, offset in enumerate(range(0, len(group), length)):
+                self.runs.setdefault((frame, tester, lane), []).extend(group[offset:offset+length])
+
+        self.runs = OrderedDict(sorted(self.runs.items(), key=lambda item: item[0][0]))
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs.values())
+
+    def clear(self):
+        """
+        Drops all tasks that have not been handed out yet and returns them.
+        """
+        tasks = [task for run in self.runs.values() for task in run]
+        self.runs.clear()
+        return tasks
+
+    def _unclaimed(self, worker):
+        claimed = set(key for other, key in self.last.items() if other != worker)
+        for key in self.runs:
+            if key not in claimed:
+                return key
+        return next(iter(self.runs), None)
+
+    def _find(self, worker):
+        if worker not in self.last:
+            return self._unclaimed(worker), None
+
+        if self.last[worker] in self.runs:
+            return self.last[worker], "frame"
+
+        frame, tester, lane = self.last[worker]
+        for key in self.runs:
+            if key[0] == frame and key[1] == tester:
+                return key, "frame"
+
+        for key in self.runs:
+            if key[1] == tester and key[2] == lane:
+                return key, "lane"
+
+        return self._unclaimed(worker), None
+
+    def next_run(self, worker, limit=None):
+        """
+        Returns the next list of tasks for the worker or None if there is no work left.
+
+        :param limit:  The maximal number of tasks to return. The rest of the run
+                       is handed out to the same worker first.
+        """
+        key, affinity = self._find(worker)
+        if key is None:
+            return None
+
+        run = self.runs[key]
+        if limit is not None and len(run) > limit:
+            run, self.runs[key] = run[:limit], run[limit:]
+        else:
+            del self.runs[key]
+        self.last[worker] = key
+
+        self.dispatched += 1
+        self.tasks += len(run)
+        if affinity == "frame":
+            self.same_frame += 1
+        elif affinity == "lane":
+            self.same_lane += 1
+        else:
+            self.cold += 1
+
+        return run
+
+    def stats(self):
+        return {
+            "runs": self.dispatched,
+            "tasks": self.tasks,
+            "same_frame": self.same_frame,
+            "same_lane": self.same_lane,
+            "cold": self.cold,
+            "run_length": self.tasks / float(self.dispatched) if self.dispatched else 0.0,
+        }
+
+    def __str__(self):
+        return ("%(runs)d runs of %(run_length).1f tasks: %(same_frame)d on the same frame and tester, "
+                "%(same_lane)d on the same tester and lane, %(cold)d cold") % self.stats()
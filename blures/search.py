@@ -0,0 +1,176 @@
+import numpy as np
+
+from blures.detection import detect, slopes
+
+
+class AdaptiveSearch(object):
+    """
+    Coarse-to-fine search over the heights of every tester and frame.
+
+    Only every n-th height is tested first. Once the coarse sweep of a
+    tester is complete for all frames, the dips of its error curve are
+    detected and the heights around them are tested at the full resolution
+    of the sweep.
+
+    The dip at the native resolution is often a single height wide and only
+    shows where a coarse grid hits it, so the grids of the testers are
+    staggered. The frames of a tester share its grid. Their curves are
+    combined by their median, which keeps dips of the source and drops the
+    noise of single frames.
+    """
+
+    def __init__(self, heights, coarse_step=16, threshold=5):
+        self.heights = sorted(heights)
+        self.coarse_step = coarse_step
+        self.threshold = threshold
+
+        self.stride = 1
+        if len(self.heights) > 1:
+            self.stride = max(1, coarse_step // (self.heights[1]-self.heights[0]))
+
+        self.frames = []
+        self.grids = {}
+        self.results = {}
+        self.skipped = set()
+        self.refined = set()
+        self.pending = 0
+
+    def grid(self, index, count):
+        """
+        Returns the coarse heights of the index-th of count testers. The
+        offsets are spread evenly over the stride.
+        """
+        offset = index * self.stride // count if count < self.stride else index % self.stride
+        return sorted(set(self.heights[offset::self.stride] + [self.heights[0], self.heights[-1]]))
+
+    def start(self, testers, frames):
+        """
+        Returns the (tester, height, frame) tuples of the coarse sweep.
+        """
+        self.frames = list(frames)
+        self.pending = len(testers)
+        for index, tester in enumerate(testers):
+            self.grids[tester] = self.grid(index, len(testers))
+            for frame in self.frames:
+                self.results[(tester, frame)] = {}
+
+        for frame in self.frames:
+            for tester in testers:
+                for height in self.grids[tester]:
+                    yield tester, height, frame
+
+    def finished(self):
+        return self.pending == 0
+
+    def curve(self, tester):
+        """
+        Returns the coarse heights of a tester and the median of the errors
+        of its frames, each scaled by its median over the grid.
+        """
+        heights, errors = [], []
+        scales = {}
+        for frame in self.frames:
+            values = [self.results[(tester, frame)][h] for h in self.grids[tester] if h in self.results[(tester, frame)]]
+            if values and np.median(values) > 0:
+                scales[frame] = np.median(values)
+
+        for height in self.grids[tester]:
+            values = [
+                self.results[(tester, frame)][height] / scales[frame]
+                for frame in scales if height in self.results[(tester, frame)]
+            ]
+            if values:
+                heights.append(height)
+                errors.append(float(np.median(values)))
+        return heights, errors
+
+    def candidates(self, tester):
+        """
+        Returns the coarse heights of a tester that lie significantly below
+        the line through their neighbours. On a coarse grid the drop into a
+        dip is often no steeper than the trend of the curve, its depth below
+        the neighbours is tested instead. The depths are compared by their
+        modified z-score, as the deltas in detect().
+        """
+        heights, errors = self.curve(tester)
+        if len(heights) < 4:
+            return []
+
+        depths = np.array([
+            errors[i] - errors[i-1] - (errors[i+1]-errors[i-1]) * (heights[i]-heights[i-1]) / float(heights[i+1]-heights[i-1])
+            for i in range(1, len(heights)-1)
+        ])
+        spread = np.median(np.abs(depths - np.median(depths)))
+        if spread == 0:
+            dips = depths < np.median(depths)
+        else:
+            dips = 0.6745 * (depths - np.median(depths)) / spread < -self.threshold
+        return [heights[i+1] for i in np.flatnonzero(dips)]
+
+    def add(self, tester, height, frame, result):
+        """
+        Records a result and returns the (tester, height, frame) tuples to
+        test next. Once the coarse sweep of a tester is complete for all
+        frames, these are the heights around its dips.
+        """
+        results = self.results.get((tester, frame))
+        if results is None:
+            return []
+        results[height] = result
+        return self.refine(tester)
+
+    def skip(self, tester, height, frame):
+        """
+        Gives up on a height that could not be tested. The coarse sweep of
+        its tester completes without it.
+        """
+        if (tester, frame) not in self.results or height not in self.grids[tester]:
+            return []
+        self.skipped.add((tester, height, frame))
+        return self.refine(tester)
+
+    def refine(self, tester):
+        """
+        Returns the tasks around the dips of a tester once its coarse sweep
+        is complete, for all of its frames.
+        """
+        if tester in self.refined:
+            return []
+        for frame in self.frames:
+            results = self.results[(tester, frame)]
+            if any(h not in results and (tester, h, frame) not in self.skipped for h in self.grids[tester]):
+                return []
+
+        self.refined.add(tester)
+        self.pending -= 1
+
+        heights = set()
+        for candidate in self.candidates(tester):
+            heights.update(h for h in self.heights if abs(h-candidate) < self.coarse_step)
+        return [
+            (tester, height, frame) for frame in self.frames
+            for height in sorted(heights) if height not in self.results[(tester, frame)]
+        ]
+
+
+def shortlist(estimates, threshold, best=None):
+    """
+    Picks the heights of a tester and frame that need a full comparison
+    after a sampled one.
+
+    :param estimates:  A dictionary mapping heights to (error, (low, high)).
+    :param best:       The lowest exact error of the tester and frame, if any.
+    :return: The heights whose interval reaches below the lowest upper bound,
+             so they might be the best one, and the dips of the estimated errors.
+    """
+    heights = sorted(estimates)
+    bound = min(high for _, (_, high) in estimates.values())
+    if best is not None:
+        bound = min(bound, best)
+    found = set(height for height in heights if estimates[height][1][0] <= bound)
+
+    errors = [estimates[height][0] for height in heights]
+    steps, deltas = slopes(heights, errors)
+    if len(deltas) > 2:
+        found.update(detect(steps, deltas, threshold))
+    return sorted(found)
@@ -0,0 +1,270 @@
+import os
+import mmap
+import uuid
+import tempfile
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+
+def _shm_dir():
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+class SharedBuffer(object):
+    """
+    A block of memory that can be mapped by name in any process.
+
+    Pickling a buffer only transfers its name, the receiving process
+    maps the same memory again.
+    """
+
+    def __init__(self, size, name=None, readonly=False):
+        self._owner = name is None
+        if name is None:
+            name = "blures-%d-%s" % (os.getpid(), uuid.uuid4().hex)
+
+        self.name = name
+        self.size = size
+        self.readonly = readonly
+        access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+
+        if os.name == "nt":
+            self.path = None
+            self.mmap = mmap.mmap(-1, size, tagname=name, access=access)
+        else:
+            self.path = os.path.join(_shm_dir(), name)
+            flags = os.O_RDONLY if readonly else os.O_RDWR
+            if self._owner:
+                flags |= os.O_CREAT | os.O_EXCL
+            fd = os.open(self.path, flags, 0o600)
+            try:
+                if self._owner:
+                    os.ftruncate(fd, size)
+                self.mmap = mmap.mmap(fd, size, access=access)
+            finally:
+                os.close(fd)
+
+    def __getstate__(self):
+        return {"name": self.name, "size": self.size, "readonly": self.readonly}
+
+    def __setstate__(self, state):
+        self.__init__(state["size"], state["name"], state["readonly"])
+
+    def array(self, offset, shape, dtype=np.uint8):
+        """
+        A view of a part of the buffer, uint8 unless another dtype is given.
+        """
+        count = int(np.prod(shape))
+        return np.frombuffer(self.mmap, dtype, count, offset).reshape(shape)
+
+    def close(self):
+        """
+        Removes the backing file. Existing mappings stay valid until
+        they are garbage collected.
+        """
+        if not self._owner or self.path is None:
+            return
+        self._owner = False
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class FrameRing(object):
+    """
+    A ring of frame sized slots in shared memory.
+
+    Workers acquire a free slot, render into it and send the slot index
+    to the main process. The slot is put back into the ring as soon as
+    the consumer releases it. The owner of every slot is recorded, so the
+    slots of a worker that died can be reclaimed.
+    """
+
+    def __init__(self, width, height, slots, channels=3):
+        self.shape = (height, width, channels)
+        self.frame_size = width * height * channels
+        self.slots = slots
+        self.memory = SharedBuffer(self.frame_size * slots)
+
+        self.free = multiprocessing.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.owners = multiprocessing.Array("i", [-1] * slots, lock=False)
+
+    def acquire(self, owner=-1):
+        slot = self.free.get()
+        self.owners[slot] = owner
+        return slot
+
+    def release(self, slot):
+        self.owners[slot] = -1
+        self.free.put(slot)
+
+    def reclaim(self, owner):
+        """
+        Releases the slots a dead worker still holds. Its results that
+        arrived must have been handled first, their slots are released
+        with them.
+        """
+        slots = [slot for slot in range(self.slots) if self.owners[slot] == owner]
+        for slot in slots:
+            self.release(slot)
+        return len(slots)
+
+    def array(self, slot):
+        """
+        A top-down RGB or luma view of the slot without copying it.
+        """
+        return self.memory.array(slot * self.frame_size, self.shape)
+
+    def get(self, slot):
+        return SharedFrame(self, slot)
+
+    def close(self):
+        self.memory.close()
+
+
+class ReferenceFrames(object):
+    """
+    Reference frames that are rendered once and mapped read-only by every worker.
+    """
+
+    def __init__(self, frames, shape):
+        self.frames = list(frames)
+        self.shape = tuple(shape)
+        self.frame_size = int(np.prod(self.shape))
+        self._memory = SharedBuffer(max(self.frame_size * len(self.frames), 1))
+        self._state = None
+
+    def __getstate__(self):
+        return {"frames": self.frames, "shape": self.shape, "name": self.memory.name, "size": self.memory.size}
+
+    def __setstate__(self, state):
+        self.frames = state["frames"]
+        self.shape = state["shape"]
+        self.frame_size = int(np.prod(self.shape))
+        self._memory = None
+        self._state = state
+
+    @property
+    def memory(self):
+        """
+        The shared memory. Unpickled copies map it on first access.
+        """
+        if self._memory is None:
+            self._memory = SharedBuffer(self._state["size"], self._state["name"], readonly=True)
+        return self._memory
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    def array(self, frame):
+        return self.memory.array(self.frames.index(frame) * self.frame_size, self.shape)
+
+    def close(self):
+        if self._memory is not None:
+            self._memory.close()
+
+
+class BestScores(object):
+    """
+    The lowest exact error of every tester and frame of a sweep, kept up
+    to date by the main process and read by the workers.
+
+    Only the main process writes and every score is a single aligned
+    float64, so readers see either the old or the new value. Scores only
+    decrease, a stale read merely prunes less.
+    """
+
+    def __init__(self, keys, margin):
+        """
+        :param keys:    The (tester, frame) tuples of the sweep.
+        :param margin:  The relative margin by which a candidate has to beat the best score.
+        """
+        self.keys = dict((key, i) for i, key in enumerate(keys))
+        self.margin = margin
+        self._memory = SharedBuffer(max(8 * len(self.keys), 8))
+        self._state = None
+        self.scores[:] = np.inf
+
+    def __getstate__(self):
+        return {"keys": self.keys, "margin": self.margin, "name": self.memory.name, "size": self.memory.size}
+
+    def __setstate__(self, state):
+        self.keys = state["keys"]
+        self.margin = state["margin"]
+        self._memory = None
+        self._state = state
+
+    @property
+    def memory(self):
+        if self._memory is None:
+            self._memory = SharedBuffer(self._state["size"], self._state["name"], readonly=True)
+        return self._memory
+
+    @property
+    def scores(self):
+        return self.memory.array(0, (self.memory.size // 8,), np.float64)
+
+    def update(self, key, score):
+        index = self.keys.get(key)
+        if index is not None and score < self.scores[index]:
+            self.scores[index] = score
+
+    def bound(self, key):
+        """
+        Returns the error above which a candidate cannot beat the best one
+        by the margin or None if there is no score yet.
+        """
+        index = self.keys.get(key)
+        if index is None:
+            return None
+        score = self.scores[index]
+        if not np.isfinite(score):
+            return None
+        return score * (1. + self.margin)
+
+    def close(self):
+        if self._memory is not None:
+            self._memory.close()
+
+
+class SharedFrame(object):
+    """
+    A result frame that still lives inside a FrameRing.
+    """
+
+    def __init__(self, ring, slot):
+        self.ring = ring
+        self.slot = slot
+
+    @property
+    def size(self):
+        height, width, _ = self.ring.shape
+        return width, height
+
+    @property
+    def array(self):
+        if self.slot is None:
+            raise ValueError("The frame has already been released.")
+        return self.ring.array(self.slot)
+
+    def to_image(self):
+        """
+        Copies the frame out of the ring.
+        """
+        array = self.array
+        if array.shape[2] == 1:
+            array = array[:, :, 0]
+        return Image.fromarray(array.copy())
+
+    def release(self):
+        if self.slot is None:
+            return
+        self.ring.release(self.slot)
+        self.slot = None
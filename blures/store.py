@@ -0,0 +1,109 @@
+import os
+import json
+import sqlite3
+import hashlib
+
+
+def cache_dir():
+    """
+    Returns the directory for persistent caches.
+    """
+    base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "blures")
+
+
+def script_key(avsfile):
+    """
+    Hashes the content of a script. Files imported by the script are not
+    part of the key.
+    """
+    digest = hashlib.sha1()
+    with open(avsfile, "rb") as f:
+        for block in iter(lambda: f.read(65536), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultStore(object):
+    """
+    Results of earlier sweeps, stored in SQLite.
+
+    Results are keyed by the script hash, a parameter key describing the
+    tester and comparison, the resolution and the frame.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS results (
+            script TEXT NOT NULL,
+            params TEXT NOT NULL,
+            tester TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            frame INTEGER NOT NULL,
+            result REAL NOT NULL,
+            channels TEXT NOT NULL,
+            PRIMARY KEY (script, params, tester, width, height, frame)
+        )
+    """
+
+    def __init__(self, path=None, commit_every=256):
+        if path is None:
+            path = os.path.join(cache_dir(), "results.sqlite")
+
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.commit_every = commit_every
+        self._pending = 0
+
+        self.db = sqlite3.connect(path)
+        self.db.execute(self.SCHEMA)
+        self.db.commit()
+
+    def load(self, script, params):
+        """
+        Returns the stored results of a script.
+
+        :param script:  The script key.
+        :param params:  A dictionary mapping tester names to their parameter keys.
+        :return: A dictionary mapping (tester, width, height, frame) to (result, channels).
+        """
+        results = {}
+        for tester, key in params.items():
+            cursor = self.db.execute(
+                "SELECT width, height, frame, result, channels FROM results "
+                "WHERE script=? AND params=? AND tester=?",
+                (script, key, tester)
+            )
+            for width, height, frame, result, channels in cursor:
+                results[(tester, width, height, frame)] = (result, tuple(json.loads(channels)))
+        return results
+
+    def add(self, script, params, tester, width, height, frame, result, channels):
+        self.db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (script, params, tester, width, height, frame, result, json.dumps(list(channels)))
+        )
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        if self._pending:
+            self.db.commit()
+            self._pending = 0
+
+    def clear(self, script=None):
+        if script is None:
+            self.db.execute("DELETE FROM results")
+        else:
+            self.db.execute("DELETE FROM results WHERE script=?", (script,))
+        self.db.commit()
+
+    def close(self):
+        self.flush()
+        self.db.close()
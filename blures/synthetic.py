@@ -0,0 +1,180 @@
+"""
+Synthetic sources with a known native resolution.
+
+write_script writes an AviSynth script that upscales colour bars from the
+native resolution. Where AviSynth is unavailable, install() replaces the
+avisynth module with a pure-Python stand-in that renders the same kind of
+source with NumPy and PIL. The stand-in implements only the functions used
+by sweeps and its resizers are not the AviSynth ones, so its scores are only
+comparable to other runs of the stand-in.
+"""
+import sys
+
+import numpy as np
+from PIL import Image
+
+from blures.cache import LRUCache
+
+
+HEADER = "# blures-synthetic"
+
+BARS = np.array([
+    (180, 180, 180), (180, 180, 16), (16, 180, 180), (16, 180, 16),
+    (180, 16, 180), (180, 16, 16), (16, 16, 180), (16, 16, 16),
+], dtype=np.float32)
+
+
+def write_script(path, native, size=(1920, 1080), frames=100, aspect_ratio=(16, 9)):
+    """
+    Writes a script that renders colour bars at the native height and
+    upscales them to size. The parameters are repeated in a header for the
+    stand-in.
+    """
+    width = int(round(native/float(aspect_ratio[1])*aspect_ratio[0]/2)*2)
+    with open(path, "w") as f:
+        f.write("%s native=%d native_width=%d width=%d height=%d frames=%d\n" % (
+            HEADER, native, width, size[0], size[1], frames
+        ))
+        f.write('ColorBars(%d, %d, pixel_type="YV24")\n' % (width, native))
+        f.write("Trim(0, %d)\n" % (frames-1))
+        f.write("Spline36Resize(%d, %d)\n" % size)
+    return path
+
+
+def read_header(path):
+    with open(path, "r") as f:
+        line = f.readline()
+    if not line.startswith(HEADER):
+        raise AvisynthError("Not a synthetic script: %s" % path)
+    return dict((key, int(value)) for key, value in (item.split("=") for item in line[len(HEADER):].split()))
+
+
+def pattern(width, height, n):
+    """
+    Colour bars with a fine pattern that moves with the frame number.
+    """
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    image = BARS[(x * len(BARS) // width).astype(np.intp)]
+    image += (40 * np.sin((x + 2*y + 3*n) * .9))[:, :, None]
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def resize(data, width, height, method):
+    return np.asarray(Image.fromarray(data).resize((width, height), method))
+
+
+class AvisynthError(Exception):
+    pass
+
+
+class AVS_VideoInfo(object):
+
+    def __init__(self, width, height, num_frames, pixel_type="RGB24"):
+        self.width = width
+        self.height = height
+        self.num_frames = num_frames
+        self.pixel_type = pixel_type
+
+    def is_rgb24(self):
+        return self.pixel_type == "RGB24"
+
+    def is_y8(self):
+        return self.pixel_type == "Y8"
+
+
+class AVS_VideoFrame(object):
+    """
+    A frame in the memory layout of AviSynth. RGB24 frames are stored
+    bottom-up in BGR order, Y8 frames top-down.
+    """
+
+    def __init__(self, data):
+        if data.ndim == 3:
+            data = data[::-1, :, ::-1]
+        self.data = np.ascontiguousarray(data)
+
+    def get_pitch(self):
+        return self.data.strides[0]
+
+    def get_read_ptr(self):
+        return self.data.ctypes.data
+
+
+class AVS_Clip(object):
+
+    def __init__(self, render, width, height, num_frames, pixel_type="RGB24"):
+        self.render = render
+        self.vi = AVS_VideoInfo(width, height, num_frames, pixel_type)
+
+    def get_video_info(self):
+        return self.vi
+
+    def get_frame(self, n):
+        return AVS_VideoFrame(self.render(min(max(n, 0), self.vi.num_frames-1)))
+
+    def get_error(self):
+        return None
+
+
+class AVS_ScriptEnvironment(object):
+
+    def __init__(self, version=3):
+        self.version = version
+
+    def invoke(self, name, args=[], arg_names=None):
+        function = getattr(self, "_" + name.lower(), None)
+        if function is None:
+            raise AvisynthError("The stand-in has no function %s" % name)
+        return function(*args)
+
+    def _loadplugin(self, path):
+        return None
+
+    def _import(self, path):
+        params = read_header(path)
+        size = params["width"], params["height"]
+        frames = LRUCache(8)
+
+        def render(n):
+            return frames.get(n, lambda: resize(
+                pattern(params["native_width"], params["native"], n), size[0], size[1], Image.BICUBIC
+            ))
+        return AVS_Clip(render, size[0], size[1], params["frames"])
+
+    def _converttorgb24(self, clip):
+        return clip
+
+    def _converttoy8(self, clip):
+        vi = clip.vi
+        if vi.is_y8():
+            return clip
+
+        def render(n):
+            data = clip.render(n).astype(np.float32)
+            return np.clip(data.dot([.299, .587, .114]) + .5, 0, 255).astype(np.uint8)
+        return AVS_Clip(render, vi.width, vi.height, vi.num_frames, "Y8")
+
+    def _scale(self, clip, width, height, method):
+        return AVS_Clip(lambda n: resize(clip.render(n), width, height, method), width, height,
+                        clip.vi.num_frames, clip.vi.pixel_type)
+
+    def _debilinear(self, clip, width, height):
+        return self._scale(clip, width, height, Image.BILINEAR)
+
+    def _debicubic(self, clip, width, height, b=1/3., c=1/3.):
+        return self._scale(clip, width, height, Image.BICUBIC)
+
+    def _bilinearresize(self, clip, width, height):
+        return self._scale(clip, width, height, Image.BILINEAR)
+
+    def _bicubicresize(self, clip, width, height):
+        return self._scale(clip, width, height, Image.BICUBIC)
+
+
+def install():
+    """
+    Makes "import avisynth" return the stand-in.
+    """
+    module = sys.modules[__name__]
+    sys.modules["avisynth"] = module
+    return module
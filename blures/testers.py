@@ -1,20 +1,32 @@
 import os
+import abc
+
+from blures.resample import Rescaler, bilinear, bicubic
 
 
 class Tester(object):
-    testers = {}
+    backend = "avisynth"
+    backends = {"avisynth": {}, "numpy": {}}
+    testers = backends["avisynth"]
+    params = {}
 
     def init(self, env):
         pass
 
+    def key(self):
+        """
+        Identifies the tester and its parameters in persistent caches.
+        """
+        return "%s%r" % (type(self).__name__, sorted(self.params.items()))
+
     def test(self, env, clip, resolution):
         pass
 
     @classmethod
     def tester(cls, name, color):
         def _decorator(new_cls):
-            cls.testers[name] = new_cls()
-            cls.testers[name].color = color
+            tester = cls.backends[new_cls.backend][name] = new_cls()
+            tester.color = color
             return cls
         return _decorator
 
@@ -68,6 +80,7 @@ class BicubicTester(Tester):
 
 @Tester.tester("catrom", "red")
 class CatRomTester(Tester):
+    params = {"b": 0, "c": 0.5}
 
     def init(self, env):
         import avisynth
@@ -86,5 +99,55 @@ class CatRomTester(Tester):
         vi = clip.get_video_info()
         width, height = vi.width, vi.height
 
-        sc_clip = env.invoke("debicubic", [clip, resolution[0], resolution[1], 0, 0.5], [None, None, "b", "c"])
+        sc_clip = env.invoke("debicubic", [clip, resolution[0], resolution[1], self.params["b"], self.params["c"]], [None, None, "b", "c"])
         return env.invoke("BicubicResize", [sc_clip, width, height])
+
+
+class NumpyTester(Tester):
+    """
+    Descales with NumPy instead of an AviSynth plugin.
+
+    test returns a Rescaler instead of a clip, the workers rescale their
+    copy of the reference frame with it. No AviSynth filter is invoked.
+    Subclasses that do not define kernel cannot be registered.
+    """
+    __metaclass__ = abc.ABCMeta
+    backend = "numpy"
+
+    @abc.abstractmethod
+    def kernel(self):
+        """
+        Returns the resampling kernel, a function of the distance with a support attribute.
+        """
+
+    def test(self, env, clip, resolution):
+        vi = clip.get_video_info()
+        return Rescaler(self.key(), self.kernel(), (vi.width, vi.height), resolution)
+
+    def evaluate(self, evaluator, resolutions):
+        """
+        Scores many resolutions against the frame of a BatchEvaluator.
+        """
+        return evaluator.evaluate(self.key(), self.kernel(), resolutions)
+
+
+@Tester.tester("bilinear", "green")
+class NumpyBilinearTester(NumpyTester):
+
+    def kernel(self):
+        return bilinear
+
+
+@Tester.tester("bicubic", "blue")
+class NumpyBicubicTester(NumpyTester):
+
+    def kernel(self):
+        return bicubic()
+
+
+@Tester.tester("catrom", "red")
+class NumpyCatRomTester(NumpyTester):
+    params = {"b": 0, "c": 0.5}
+
+    def kernel(self):
+        return bicubic(self.params["b"], self.params["c"])
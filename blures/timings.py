@@ -0,0 +1,127 @@
+import bisect
+
+
+class Histogram(object):
+    """
+    Counts durations in logarithmic buckets from 0.1ms to 10s.
+    """
+
+    BOUNDS = tuple(scale * 10**exp for exp in range(-4, 1) for scale in (1, 2, 5)) + (10.0,)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket containing the p-th percentile.
+        """
+        if not self.count:
+            return 0.0
+
+        rank = p / 100. * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS + (self.max,), self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "bounds": list(self.BOUNDS),
+            "counts": list(self.counts),
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+        }
+
+
+class PhaseTimings(object):
+    """
+    Aggregates the phase timings of every task into histograms per tester
+    and per resolution.
+
+    Workers measure how long a task spent looking up or building the tester
+    clip, rendering the frame, waiting for a free ring slot, copying the
+    frame and comparing it. The main process adds how long the result waited
+    in the result queue.
+    """
+
+    PHASES = ("clip", "render", "slot", "copy", "compare", "queue")
+
+    def __init__(self):
+        self.testers = {}
+        self.resolutions = {}
+
+    @staticmethod
+    def _histograms(groups, key):
+        histograms = groups.get(key)
+        if histograms is None:
+            histograms = groups[key] = dict((phase, Histogram()) for phase in PhaseTimings.PHASES + ("total",))
+        return histograms
+
+    def add(self, tester, width, height, timings):
+        """
+        :param timings:  A dictionary mapping phases to seconds.
+        """
+        total = sum(timings.get(phase, 0.0) for phase in self.PHASES)
+        for histograms in (self._histograms(self.testers, tester),
+                           self._histograms(self.resolutions, (width, height))):
+            for phase in self.PHASES:
+                if phase in timings:
+                    histograms[phase].add(timings[phase])
+            histograms["total"].add(total)
+
+    def __len__(self):
+        return sum(histograms["total"].count for histograms in self.testers.values())
+
+    def to_dict(self):
+        return {
+            "testers": dict(
+                (tester, dict((phase, h.to_dict()) for phase, h in histograms.items()))
+                for tester, histograms in self.testers.items()
+            ),
+            "resolutions": dict(
+                ("%dx%d" % resolution, dict((phase, h.to_dict()) for phase, h in histograms.items()))
+                for resolution, histograms in self.resolutions.items()
+            ),
+        }
+
+    def summary(self, slowest=5):
+        """
+        Returns a table of the mean and 90th percentile of every phase per
+        tester, followed by the resolutions with the highest mean total time.
+        """
+        columns = self.PHASES + ("total",)
+        lines = ["%-12s %6s  %s" % ("tester", "tasks", "  ".join("%13s" % phase for phase in columns))]
+
+        def row(name, histograms):
+            cells = "  ".join(
+                "%6.1f/%6.1f" % (histograms[phase].mean()*1000, histograms[phase].percentile(90)*1000)
+                for phase in columns
+            )
+            return "%-12s %6d  %s" % (name, histograms["total"].count, cells)
+
+        for tester in sorted(self.testers):
+            lines.append(row(tester, self.testers[tester]))
+
+        ranked = sorted(self.resolutions.items(), key=lambda item: item[1]["total"].mean(), reverse=True)
+        if ranked:
+            lines.append("slowest resolutions:")
+        for resolution, histograms in ranked[:slowest]:
+            lines.append(row("%dx%d" % resolution, histograms))
+
+        lines.append("(mean/p90 in ms)")
+        return "\n".join(lines)
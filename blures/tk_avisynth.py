@@ -12,6 +12,8 @@ from blures.testers import Tester
 def queue_command(func):
     def _call_wrapped_func(data):
         self, args, kwargs, fut = data
+        if fut.is_done():
+            return
         try:
             fut.set_result(func(self, *args, **kwargs))
         except Exception as e:
@@ -36,13 +38,8 @@ class AvisynthThread(threading.Thread):
 
     def run(self):
         self.avisynth = avisynth.AVS_ScriptEnvironment()
-        qempty = Queue.Empty
         while True:
-            try:
-                func, data = self.queue.get(timeout=1)
-            except qempty:
-                continue
-
+            func, data = self.queue.get()
             func(data)
 
     @queue_command
@@ -51,11 +48,9 @@ class AvisynthThread(threading.Thread):
 
     @queue_command
     def get_frame(self, clip, n):
-        buf = ScaleWorker.create_buffer(clip)
-        return ScaleWorker.get_frame(buf, self.avisynth, clip, n)
+        return ScaleWorker.get_frame(self.avisynth, clip, n)
 
     @queue_command
-    def get_tester_frame(self, clip, tester, height, n):
-        buf = ScaleWorker.create_buffer(clip)
-        tclip = Tester.testers[tester].test(self.avisynth, clip, Executor.get_resolution(height))
-        return ScaleWorker.get_frame(buf, self.avisynth, tclip, n)
\ No newline at end of file
+    def get_tester_frame(self, clip, tester, height, n, aspect_ratio=(16, 9)):
+        tclip = Tester.testers[tester].test(self.avisynth, clip, Executor.get_resolution(height, aspect_ratio))
+        return ScaleWorker.get_frame(self.avisynth, tclip, n)
\ No newline at end of file
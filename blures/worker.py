@@ -1,14 +1,68 @@
-import math
+import os
 import time
-import Queue
 import ctypes
 import multiprocessing
-from multiprocessing.queues import SimpleQueue
+from collections import deque, namedtuple, OrderedDict
 
 import numpy as np
-from PIL import Image, ImageChops
+from PIL import Image
 
 from blures.testers import Tester
+from blures.compare import Comparator, SampledComparator, create_sample, parse_sample
+from blures.cache import LRUCache
+from blures.pool import POOLS
+from blures.sharedmem import ReferenceFrames, BestScores
+from blures.scheduler import Scheduler
+from blures.search import AdaptiveSearch, shortlist
+from blures.store import script_key, cache_dir
+from blures.checkpoint import Checkpoint
+from blures.timings import PhaseTimings
+from blures.profiling import WorkerProfiler, PROFILE_MODES, report as profile_report
+from blures.resample import BatchEvaluator, Rescaler, operator_dir, reserve_operators
+
+
+class Result(namedtuple("Result", "tester width height frame score channels time worker image interval")):
+    """
+    A single comparison. time is the number of seconds between the start of
+    the sweep and the end of the comparison, time and worker are None for
+    results replayed from a cache. image is None unless it was requested.
+    interval is the (low, high) confidence interval of an estimated score
+    and None for exact ones. Comparisons that were stopped early score a
+    lower bound with an interval of (score, None).
+    """
+    __slots__ = ()
+
+
+class ResultTimeout(Exception):
+    pass
+
+
+class FrameView(object):
+    """
+    Exposes the pixels of a RGB24 or Y8 AVS_VideoFrame to NumPy without copying them.
+
+    AviSynth stores RGB frames bottom-up in BGR order. The view starts at the
+    last row with a negative row stride and walks the channels backwards.
+    Y8 frames are stored top-down and get a single channel.
+    """
+
+    def __init__(self, frame, width, height, channels=3):
+        self.frame = frame
+
+        pitch = frame.get_pitch()
+        ptr = ctypes.cast(frame.get_read_ptr(), ctypes.c_void_p).value
+        if channels == 1:
+            data, strides = ptr, (pitch, 1, 1)
+        else:
+            data, strides = ptr + (height-1)*pitch + 2, (-pitch, 3, -1)
+
+        self.__array_interface__ = {
+            "version": 3,
+            "shape": (height, width, channels),
+            "typestr": "|u1",
+            "data": (data, True),
+            "strides": strides,
+        }
 
 
 class ScaleWorker(object):
@@ -17,124 +71,437 @@ class ScaleWorker(object):
     """
 
     @staticmethod
-    def create_buffer(clip):
-        vi = clip.get_video_info()
-        w, h = vi.width, vi.height
-        stride = (24/8)*w
-        return ctypes.create_string_buffer(stride*h)
+    def get_frame_array(env, clip, n):
+        import avisynth
 
-    @staticmethod
-    def get_frame(buf, env, clip, n):
         frame = clip.get_frame(n)
+        if frame is None:
+            raise avisynth.AvisynthError(clip.get_error())
+
         vi = clip.get_video_info()
-        w, h = vi.width, vi.height
-        stride = (24/8)*w
-        pBuf = ctypes.cast(buf, ctypes.POINTER(ctypes.c_ubyte))
+        return np.asarray(FrameView(frame, vi.width, vi.height, 1 if vi.is_y8() else 3))
 
-        env.bit_blt(pBuf, stride, frame.get_read_ptr(), frame.get_pitch(), frame.get_row_size(), frame.get_height())
-        image = Image.frombytes("RGB", (w, h), ctypes.string_at(buf, stride*h), "raw", "BGR")
-        return image.rotate(180).transpose(Image.FLIP_LEFT_RIGHT)
+    @staticmethod
+    def get_frame(env, clip, n):
+        data = ScaleWorker.get_frame_array(env, clip, n)
+        if data.shape[2] == 1:
+            data = data[:, :, 0]
+        return Image.fromarray(np.ascontiguousarray(data))
+
+    @staticmethod
+    def load_clip(env, avsfile, luma=False):
+        """
+        Imports a script as RGB24 or, in luma mode, as the Y8 plane of its
+        native clip. Extracting the plane of a YUV clip converts no colours.
+        """
+        clip = env.invoke("Import", [avsfile])
+        return env.invoke("ConvertToY8" if luma else "ConvertToRGB24", [clip])
 
     def write_raw(self, type, data):
         if hasattr(self.out_queue, "send"):
-            self.out_queue.send((type, self.no, data))
+            self.out_queue.send((type, self.no, self.sweep, data))
         else:
-            self.out_queue.put((type, self.no, data))
+            self.out_queue.put((type, self.no, self.sweep, data))
 
     def write_message(self, message):
         self.write_raw("message", message)
 
-    def write_result(self, tester, width, height, frame, result, image, time):
-        self.write_raw("result", (tester, width, height, frame, result, image, time))
+    def write_result(self, tester, width, height, frame, result, channels, slot, time, timings):
+        self.write_raw("result", (tester, width, height, frame, result, channels, slot, time, timings))
 
-    def write_restart(self):
-        self.write_raw("restart", ())
+    def write_failure(self, tester, width, height, frame, error):
+        self.write_message("Error in %dx%d@%d: %s" % (width, height, frame, error))
+        self.write_raw("failed", (tester, width, height, frame, str(error)))
+
+    def write_idle(self):
+        self.write_raw("idle", str(self.clips))
+
+    profiler = None
 
     @classmethod
-    def start(cls, no, avsfile, frames, in_queue, out_queue):
+    def start(cls, no, avsfile, in_queue, out_queue, ring, cancelled, clip_cache=64, profile=None, luma=False):
         sw = ScaleWorker()
-        sw.run(no, avsfile, frames, in_queue, out_queue)
+        if profile is None:
+            sw.run(no, avsfile, in_queue, out_queue, ring, cancelled, clip_cache, luma)
+            return
 
-    def run(self, no, avsfile, frames, in_queue, out_queue):
-        def _get_frame(env, clip, frame):
-            fr = self.get_frame(self.buf, env, clip, frame)
-            return fr, self.compare(fr, fr)
+        sw.profiler = WorkerProfiler(profile[0], profile[1], "worker-%d" % no)
+        sw.profiler.start()
+        try:
+            sw.run(no, avsfile, in_queue, out_queue, ring, cancelled, clip_cache, luma)
+        finally:
+            sw.profiler.stop()
 
+    def run(self, no, avsfile, in_queue, out_queue, ring, cancelled, clip_cache=64, luma=False):
+        """
+        Serves sweeps until the worker is shut down.
+
+        The input queue carries ("sweep", id, references, backend, sample, best, operators), ("run", tasks),
+        ("sample", tasks), ("batch", tasks, operator_dir), ("end",) and ("shutdown",) commands.
+        Between sweeps the worker blocks on the queue.
+        Tasks of sweeps up to the id in cancelled are skipped.
+        """
         import avisynth
 
         self.no = no
         self.avsfile = avsfile
         self.in_queue = in_queue
         self.out_queue = out_queue
-        self.frames = frames
+        self.ring = ring
+        self.cancelled = cancelled
+        self.sweep = None
+        self.frames = {}
+        self.evaluators = {}
+        self.samples = {}
+        self.best = None
+        self.testers = Tester.testers
+        self.clips = LRUCache(clip_cache)
 
         self.write_message("Initializing avisynth")
-        env = avisynth.AVS_ScriptEnvironment(3)
+        self.env = avisynth.AVS_ScriptEnvironment(3)
         for tester in Tester.testers.values():
-            tester.init(env)
+            tester.init(self.env)
 
         self.write_message("Loading video...")
-        clip = env.invoke("ConvertToRGB24", [env.invoke("Import", [self.avsfile])])
+        self.clip = self.load_clip(self.env, self.avsfile, luma)
+        self.scratch = Comparator.create_scratch(self.ring.shape)
 
-        self.buf = self.create_buffer(clip)
+        while True:
+            command = self.in_queue.get()
+            if command[0] == "sweep":
+                self.start_sweep(*command[1:])
+            elif command[0] == "run":
+                self.process(command[1])
+            elif command[0] == "sample":
+                self.process_sample(command[1])
+            elif command[0] == "batch":
+                self.process_batch(command[1], command[2])
+            elif command[0] == "end":
+                if self.profiler is not None:
+                    self.profiler.dump()
+                if not self.is_cancelled():
+                    self.write_idle()
+            elif command[0] == "shutdown":
+                break
 
-        self.write_message("Rendering comparison frames")
-        self.frames = {
-            frame: _get_frame(env, clip, frame)
-            for frame in frames
-        }
+    def start_sweep(self, sweep, references, backend="avisynth", sample=None, best=None, operators=None):
+        """
+        :param best:       The BestScores of the sweep if candidates that cannot
+                           beat them are to be stopped early.
+        :param operators:  The number of NumPy rescale operators of the sweep.
+        """
+        self.sweep = sweep
+        if operators is not None:
+            reserve_operators(operators)
+        self.testers = Tester.backends[backend]
+        self.evaluators = {}
+        self.samples = {}
+        self.best = best
+        try:
+            self.frames = dict(
+                (frame, Comparator(references.array(frame), self.scratch))
+                for frame in references
+            )
+        except (OSError, EnvironmentError):
+            if not self.is_cancelled():
+                raise
+            self.frames = {}
+
+        if sample is not None:
+            self.samples = dict(
+                (frame, SampledComparator(comparator, create_sample(sample, comparator.reference)))
+                for frame, comparator in self.frames.items()
+            )
+
+    def is_cancelled(self):
+        return self.sweep <= self.cancelled.value
+
+    def get_bound(self, tester, frame):
+        """
+        Returns the error at which a comparison is stopped or None. The best
+        scores are mapped on first use, if that fails pruning is disabled.
+        """
+        if self.best is None:
+            return None
+        try:
+            return self.best.bound((tester, frame))
+        except (OSError, EnvironmentError) as e:
+            if not self.is_cancelled():
+                self.write_message("Pruning disabled, the best scores are not available: %s" % e)
+            self.best = None
+            return None
+
+    def get_test_clip(self, tester, width, height):
+        tester_inst = self.testers[tester]
+        return tester_inst, self.clips.get(
+            (tester_inst.backend, tester, width, height),
+            lambda: tester_inst.test(self.env, self.clip, (width, height))
+        )
+
+    def process(self, run):
+        import avisynth
+
+        env = self.env
+        for tester, width, height, frame in run:
+            if self.is_cancelled():
+                return
+
+            timings = {}
+            start = time.time()
 
-        self.write_message("Working on queue")
-        count = -1
-        while count != 0:
+            comparator = self.frames[frame]
+            bound = self.get_bound(tester, frame)
             try:
-                tester, width, height, frame = self.in_queue.get(timeout=5)
-            except Queue.Empty:
-                self.write_message("Empty queue detected.")
-                break
+                tester_inst, test_clip = self.get_test_clip(tester, width, height)
+                now = time.time()
+                timings["clip"], start = now - start, now
+
+                if tester_inst.backend != "numpy":
+                    data = self.get_frame_array(env, test_clip, frame)
+                elif bound is None:
+                    data = test_clip.rescale(comparator.reference)
+                else:
+                    data = test_clip.rescale_bands(comparator.reference, comparator.bands)
+            except avisynth.AvisynthError as e:
+                self.write_failure(tester, width, height, frame, e)
+                continue
+            now = time.time()
+            timings["render"], start = now - start, now
+
+            slot = self.ring.acquire(self.no)
+            if self.is_cancelled():
+                self.ring.release(slot)
+                return
+            now = time.time()
+            timings["slot"], start = now - start, now
+
+            target = self.ring.array(slot)
+            if bound is None:
+                np.copyto(target, data)
+                del data
+                now = time.time()
+                timings["copy"], start = now - start, now
+
+                result, channels = comparator.compare(target)
+                complete = True
+            else:
+                if tester_inst.backend != "numpy":
+                    data = [data[first:last] for first, last in comparator.bands]
+                # The bands are copied into the slot while they are compared.
+                result, channels, complete = comparator.compare_bounded(data, bound, target)
+                del data
+            now = time.time()
+            timings["compare"] = now - start
 
-            tester_inst = Tester.testers[tester]
-            test_clip = tester_inst.test(env, clip, (width, height))
+            if complete:
+                self.write_result(tester, width, height, frame, result, tuple(channels.tolist()), slot, now, timings)
+            else:
+                self.ring.release(slot)
+                self.write_raw("pruned", (tester, width, height, frame, result, tuple(channels.tolist()), now, timings))
 
+    def process_sample(self, run):
+        """
+        Estimates the errors of the tasks of a run from the sampled pixels
+        of their frames. Results carry a confidence interval and no image.
+        The numpy backend only renders the sampled rows and columns of a
+        grid sample.
+        """
+        import avisynth
+
+        for tester, width, height, frame in run:
+            if self.is_cancelled():
+                return
+
+            timings = {}
+            start = time.time()
+
+            comparator = self.samples[frame]
             try:
-                image = self.get_frame(self.buf, env, test_clip, frame)
-            except avisynth.AvisynthError:
-                self.write_message("Error in %dx%d@%d" % (width, height, frame))
-                raise
+                tester_inst, test_clip = self.get_test_clip(tester, width, height)
+                now = time.time()
+                timings["clip"], start = now - start, now
 
-            ratio = self.compare(image, self.frames[frame][0])/self.frames[frame][1]
-            self.write_result(tester, width, height, frame, ratio, image, time.time())
+                if tester_inst.backend == "numpy":
+                    pixels = test_clip.rescale_sample(self.frames[frame].reference, comparator.sample)
+                else:
+                    pixels = comparator.sample.take(self.get_frame_array(self.env, test_clip, frame))
+            except avisynth.AvisynthError as e:
+                self.write_failure(tester, width, height, frame, e)
+                continue
+            now = time.time()
+            timings["render"], start = now - start, now
 
-            count -= 1
+            result, channels, interval = comparator.compare(pixels)
+            now = time.time()
+            timings["compare"] = now - start
 
-        if count == 0:
-            self.write_restart()
-            while True:
-                pass
+            self.write_raw("sampled", (tester, width, height, frame, result, tuple(channels.tolist()), interval,
+                                       now, timings))
+
+    def process_batch(self, run, directory=None):
+        """
+        Scores the tasks of a run with the NumPy backend without rendering
+        frames. All tasks sharing a tester and frame are evaluated in one pass
+        and reported in a single message.
+        """
+        groups = OrderedDict()
+        for task in run:
+            groups.setdefault((task[0], task[3]), []).append(task)
+
+        for (tester, frame), tasks in groups.items():
+            if self.is_cancelled():
+                return
 
-    def compare(self, generated, original):
-        h = np.array(ImageChops.difference(generated, original).histogram(), dtype=np.uint64)
-        return math.sqrt(np.sum((h**2)*np.arange(len(h))) / (float(original.size[0]) * original.size[1]))
+            start = time.time()
+            evaluator = self.evaluators.get(frame)
+            if evaluator is None:
+                evaluator = self.evaluators[frame] = BatchEvaluator(self.frames[frame].reference, directory)
+
+            sse = self.testers[tester].evaluate(evaluator, [(width, height) for _, width, height, _ in tasks])
+            combined, channels = self.frames[frame].error(sse)
+            now = time.time()
+
+            # The pass is shared, every task is accounted an equal part of it.
+            timings = {"compare": (now - start) / len(tasks)}
+            self.write_raw("batch", [
+                (tester, width, height, frame, float(result), tuple(channel.tolist()), now, timings)
+                for (_, width, height, _), result, channel in zip(tasks, combined, channels)
+            ])
 
 
 class Executor(object):
 
-    def __init__(self, avsfile, heights, frames, aspect_ratio=(16,9), cpus=None):
+    def __init__(self, avsfile, heights, frames, aspect_ratio=(16,9), cpus=None, clip_cache=64,
+                 search="full", coarse_step=16, threshold=5, pool=None, keep_warm=False, window=8,
+                 store=None, checkpoint=None, checkpoint_interval=30, mode="process", profile=None,
+                 profile_dir=None, backend="avisynth", batch=False, luma=False, sample=None, prune=None):
+        """
+        :param batch:   Score whole runs of heights in a single pass without
+                        rendering frames. Needs the numpy backend, results
+                        carry no image.
+        :param luma:    Test and compare the luma plane instead of RGB frames.
+        :param sample:  Estimate the errors from "grid:STEP" or "tiles:FRACTION[:SIZE]"
+                        of every frame first and compare only the shortlisted
+                        heights in full. Estimates carry a confidence interval.
+        :param prune:   Stop comparisons once their error exceeds the best
+                        exact error of the tester and frame by this relative
+                        margin. Stopped candidates score a lower bound.
+        """
         import avisynth
 
         self.avsfile = avsfile
 
+        if backend not in Tester.backends:
+            raise ValueError("Unknown tester backend: %s" % backend)
+        if batch and backend != "numpy":
+            raise ValueError("Batched evaluation needs the numpy backend.")
+        if sample is not None:
+            parse_sample(sample)
+            if batch:
+                raise ValueError("Sampled comparison cannot be combined with batched evaluation.")
+        if prune is not None:
+            if prune < 0:
+                raise ValueError("The pruning margin cannot be negative.")
+            if batch:
+                raise ValueError("Pruning cannot be combined with batched evaluation.")
+        self.backend = backend
+        self.batch = batch
+        self.luma = luma
+        self.sample = sample
+        self.prune = prune
+        self.testers = Tester.backends[backend]
+
         self.env = avisynth.AVS_ScriptEnvironment(3)
-        for tester in Tester.testers.values():
+        for tester in self.testers.values():
             tester.init(self.env)
-        self.clip = self.env.invoke("ConvertToRGB24", [self.env.invoke("Import", [self.avsfile])])
+        self.clip = ScaleWorker.load_clip(self.env, self.avsfile, luma)
 
         self.fstep = list(frames)
         self.hstep = list(heights)
         self.cpus = cpus
+        self.clip_cache = clip_cache
+
+        self.search = search
+        self.coarse_step = coarse_step
+        self.threshold = threshold
+        self.adaptive = None
+
+        if mode not in POOLS:
+            raise ValueError("Unknown execution mode: %s" % mode)
+        self.mode = mode
+
+        if profile is not None and profile not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode: %s" % profile)
+        if profile is not None and profile_dir is None:
+            profile_dir = os.path.join(cache_dir(), "profiles", time.strftime("%Y%m%d-%H%M%S"))
+        if profile_dir is not None and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        self.profile = profile
+        self.profile_dir = profile_dir
+
+        self.pool = pool
+        self.keep_warm = keep_warm
+        self.window = max(window, 2)
+        self.store = store
+
+        self.checkpoint = None
+        if checkpoint is not None:
+            self.checkpoint = Checkpoint(checkpoint, checkpoint_interval)
+        self.completed = {}
+        self.pending = []
 
         self.aspect_ratio = aspect_ratio
 
+    def config(self):
+        """
+        The arguments needed to recreate this executor.
+        """
+        return {
+            "avsfile": self.avsfile,
+            "heights": self.hstep,
+            "frames": self.fstep,
+            "aspect_ratio": list(self.aspect_ratio),
+            "cpus": self.cpus,
+            "clip_cache": self.clip_cache,
+            "search": self.search,
+            "coarse_step": self.coarse_step,
+            "threshold": self.threshold,
+            "window": self.window,
+            "mode": self.mode,
+            "profile": self.profile,
+            "backend": self.backend,
+            "batch": self.batch,
+            "luma": self.luma,
+            "sample": self.sample,
+            "prune": self.prune,
+        }
+
+    @classmethod
+    def resume(cls, checkpoint, **kwargs):
+        """
+        Creates an executor that continues the sweep of a checkpoint.
+
+        Completed results are replayed through the callback. The tasks that
+        were outstanding are sent to the workers first, then the rest of
+        the plan.
+        """
+        config, results, pending, complete = Checkpoint(checkpoint).load()
+        config = dict(config)
+
+        script = config.pop("script", None)
+        if script is not None and script != script_key(config["avsfile"]):
+            raise ValueError("The script has changed since the checkpoint was written.")
+
+        config["aspect_ratio"] = tuple(config["aspect_ratio"])
+        config.update(kwargs)
+        config.setdefault("checkpoint", checkpoint)
+
+        print("[Main] Resuming with %d results, %d tasks outstanding" % (len(results), len(pending)))
+        executor = cls(**config)
+        executor.completed = results
+        executor.pending = pending
+        return executor
+
     @staticmethod
     def get_resolutions(height_step, aspect_ratio=(16,9)):
         for height in height_step:
@@ -150,111 +517,591 @@ class Executor(object):
             yield frame
 
     def get_vals(self, frames):
-        for name, tester in Tester.testers.items():
-            for frame in frames:
+        for frame in sorted(frames):
+            for name, tester in self.testers.items():
                 for width, height in self.get_resolutions(self.hstep, aspect_ratio=self.aspect_ratio):
                     yield name, width, height, frame
 
+    def get_task(self, tester, height, frame):
+        width, height = self.get_resolution(height, self.aspect_ratio)
+        return tester, width, height, frame
+
+    def get_plan(self, frames):
+        if self.search == "full":
+            self.adaptive = None
+            return self.get_vals(frames)
+
+        if self.search == "adaptive":
+            self.adaptive = AdaptiveSearch(self.hstep, self.coarse_step, self.threshold)
+            coarse = self.adaptive.start(list(self.testers.keys()), sorted(frames))
+            return (self.get_task(*task) for task in coarse)
+
+        raise ValueError("Unknown search mode: %s" % self.search)
+
+    def result_key(self, tester):
+        key = "%s|%s" % (tester.key(), Comparator.metric)
+        if self.luma:
+            key += "|luma"
+        # Batched scores are exact least-squares residuals of frames that are never rounded to 8 bits.
+        if self.batch:
+            key += "|batch"
+        # NumPy scores change with the rescale, stored ones are only reused for the same version.
+        elif self.backend == "numpy":
+            key += "|rescale%d" % Rescaler.VERSION
+        return key
+
+    def render_references(self, frames):
+        """
+        Renders the reference frames into shared memory for all workers.
+        """
+        vi = self.clip.get_video_info()
+        references = ReferenceFrames(frames, (vi.height, vi.width, 1 if self.luma else 3))
+        for frame in frames:
+            np.copyto(references.array(frame), ScaleWorker.get_frame_array(self.env, self.clip, frame))
+        return references
+
+    def get_pool(self):
+        """
+        Returns the pool of the sweep, whether it is private to the sweep and
+        the id of the sweep. Pools that run another sweep are not shared, a
+        private pool is started instead.
+        """
+        vi = self.clip.get_video_info()
+        size = (vi.width, vi.height)
+        pool_class = POOLS[self.mode]
+        profile = (self.profile, self.profile_dir) if self.profile is not None else None
+
+        pool = self.pool
+        if pool is None and self.keep_warm:
+            pool = pool_class.shared(self.avsfile, self.cpus, size, self.clip_cache, profile, self.luma)
+        if pool is not None:
+            sweep = pool.claim()
+            if sweep is not None:
+                return pool, False, sweep
+            print("[Main] The pool is running another sweep, starting a private one")
+
+        pool = pool_class(self.avsfile, self.cpus, size, self.clip_cache, profile, self.luma)
+        return pool, True, pool.claim()
+
     def test(self):
         print("[Main] Generating Comparison Frames.")
 
-        vals = self.get_vals(list(self.get_frames(self.fstep)))
-
         if self.cpus is None:
             try:
                 self.cpus = multiprocessing.cpu_count()
             except NotImplementedError:
                 self.cpus = 1
 
-        in_queue = multiprocessing.Queue()
-        main_queue = multiprocessing.Queue()
+        frames = list(self.get_frames(self.fstep))
+        self.scheduler = scheduler = Scheduler([], self.cpus)
 
-        print("[Main] Starting workers (%d)" % self.cpus)
+        cached = {}
+        replay = deque()
+        planned = set()
+        completed = self.completed
+        script = None
+        if self.store is not None or self.checkpoint is not None:
+            script = script_key(self.avsfile)
+        if self.store is not None:
+            params = dict((name, self.result_key(tester)) for name, tester in self.testers.items())
+            cached = self.store.load(script, params)
+        cached.update(completed)
 
-        starttime = time.time()
-        running_workers = {}
-        workers = []
-        queues = [main_queue]
-        for i in range(self.cpus):
-            main_queue.put(("restart", i, ()))
+        # Sampled sweeps: estimates wait per (tester, frame) until all of its sampled tasks are back
+        # and are held until its shortlist is compared in full.
+        exact = set()
+        estimates = {}
+        outstanding = {}
+        held = {}
+        ratios = {}
+        best = {}
+        pruned = set()
+        failed = {}
+        # Tasks reported with an estimate or a lower bound. They stay pending in the checkpoint and are
+        # compared again on resume.
+        approximate = set()
 
-        starttime = time.time()
-        class _data(object): pass
+        def improve(key, result):
+            best[key] = min(result, best.get(key, result))
+            if bounds is not None:
+                bounds.update(key, result)
 
-        def test_loopcb(item_update):
-            while _data.next_obj is not None:
-                in_queue.put(_data.next_obj, 1)
-                _data.next_obj = next(vals, None)
+        def submit(tasks):
+            fresh = []
+            for task in tasks:
+                if task in planned:
+                    continue
+                planned.add(task)
 
-            found = False
-            for queue in queues:
-                try:
-                    if hasattr(queue, "empty"):
-                        if queue.empty():
-                            continue
+                if task in cached:
+                    replay.append(task)
+                else:
+                    fresh.append(task)
+                    if self.sample is not None:
+                        key = (task[0], task[3])
+                        outstanding[key] = outstanding.get(key, 0) + 1
+            scheduler.add(fresh)
 
-                        type, worker, data = queue.get()
-                    else:
-                        if not queue.poll():
-                            continue
-                        type, worker, data = queue.recv()
+        # The outstanding tasks of a resumed sweep include refinements and shortlists the plan does not repeat.
+        submit(task for task in self.pending if task[0] in self.testers and task[3] in frames)
+        submit(self.get_plan(frames))
+        adaptive = self.adaptive
+        if cached:
+            print("[Main] %d results cached, %d tasks left" % (len(replay), len(scheduler)))
 
-                except Queue.Empty:
-                    continue
+        references = self.render_references(frames)
+        bounds = None
+        if self.prune is not None:
+            bounds = BestScores([(name, frame) for name in self.testers for frame in frames], self.prune)
+
+        # A vertical and a horizontal operator for every height and kernel.
+        operators = 2 * len(self.hstep) * len(self.testers) if self.backend == "numpy" else None
+
+        pool, private, sweep = self.get_pool()
+        print("[Main] Starting workers (%d)" % pool.cpus)
+        pool.start()
+        ring = pool.ring
+
+        assigned = {}
+        running = {}
+        delivered = set()
+        finished = set()
+        cancelled = [False]
+
+        def dispatch(worker):
+            while assigned[worker] is not None and assigned[worker] <= self.window // 2:
+                run = scheduler.next_run(worker, self.window - assigned[worker])
+                if run is None:
+                    if (adaptive is not None and not adaptive.finished()) or any(outstanding.values()):
+                        return
+                    pool.send(worker, ("end",))
+                    assigned[worker] = None
+                    return
+                assigned[worker] += len(run)
+                if self.sample is not None:
+                    # The worker estimates the sampled tasks before it compares the others in full.
+                    run = [task for task in run if task not in exact] + [task for task in run if task in exact]
+                running[worker].extend(run)
+                if self.batch:
+                    pool.send(worker, ("batch", run, operator_dir()))
+                elif self.sample is not None:
+                    sampled = [task for task in run if task not in exact]
+                    if sampled:
+                        pool.send(worker, ("sample", sampled))
+                    if len(sampled) < len(run):
+                        pool.send(worker, ("run", [task for task in run if task in exact]))
                 else:
-                    found = True
-                    break
+                    pool.send(worker, ("run", run))
 
-            queues.remove(queue)
-            queues.append(queue)
+        starttime = time.time()
+        for worker in pool.workers:
+            assigned[worker] = 0
+            running[worker] = []
+            pool.send(worker, ("sweep", sweep, references, self.backend, self.sample, bounds, operators))
+            dispatch(worker)
 
-            if not found:
-                alive = False
-                if len(workers) > 0:
-                    for worker in workers:
-                        if worker.is_alive():
-                            alive = True
-                            break
+        timings = self.timings = PhaseTimings()
+        stats = self.stats = {
+            "results": 0,
+            "batches": 0,
+            "peak_batch": 0,
+            "throughput": 0.0,
+            "cached": 0,
+            "estimated": 0,
+            "pruned": 0,
+            "failed": 0,
+            "planned": len(planned),
+            "pending": len(scheduler),
+            "in_flight": 0,
+        }
 
-                if not alive:
+        def done():
+            if replay:
+                return False
+            for worker in pool.workers:
+                if worker not in finished and pool.is_alive(worker):
                     return False
-                else:
-                    return True
+            return True
+
+        def save_checkpoint():
+            if self.checkpoint is None:
+                return
+            config = self.config()
+            config["script"] = script
+            pending = [task for task in planned if task not in completed]
+            self.checkpoint.save(config, completed, pending,
+                                 all(task in approximate or task in failed for task in pending))
+
+        def advance(tester, height, frame, result):
+            """
+            Feeds a result to the adaptive search. A result of None resolves
+            the height without a value, the search continues without it.
+            """
+            if adaptive is None:
+                return
+
+            if result is None:
+                refine = adaptive.skip(tester, height, frame)
+            else:
+                refine = adaptive.add(tester, height, frame, result)
+            if refine:
+                submit(self.get_task(*task) for task in refine)
+            if refine or adaptive.finished():
+                for other in list(assigned):
+                    dispatch(other)
+
+        def take(worker, task):
+            """
+            Removes a task from the tasks in flight of a worker. Returns False
+            if it was handed out again since, its result is then dropped.
+            """
+            if task not in running[worker]:
+                return False
+            running[worker].remove(task)
+            delivered.add(worker)
+            if assigned[worker]:
+                assigned[worker] -= 1
+            return True
+
+        def give_up(task, message, item_update, detailed):
+            """
+            Drops a task that could not be rendered. The adaptive search and
+            the shortlists of sampled sweeps continue without it.
+            """
+            tester, width, height, frame = task
+            print("[Main] Gave up on %s %dx%d@%d: %s" % (task + (message,)))
+            failed[task] = message
+            stats["failed"] += 1
+
+            key = (tester, frame)
+            if self.sample is not None and task not in exact:
+                outstanding[key] -= 1
+                if not outstanding[key]:
+                    resolve(key, item_update, detailed)
+            elif key in held:
+                held[key][0].discard(task)
+                if not held[key][0]:
+                    release(key, item_update, detailed)
+
+            advance(tester, height, frame, None)
+
+        def recover(item_update, detailed):
+            """
+            Gives up the tasks in flight of dead workers and restarts them.
+            Results a worker sent just before it died may be lost, so it is
+            not known which of its tasks killed it. Workers that died before
+            delivering anything are not restarted, once none is left all
+            remaining tasks are given up.
+            """
+            dead = [
+                worker for worker in pool.workers
+                if worker not in finished and assigned[worker] is not None and not pool.is_alive(worker)
+            ]
+            if dead:
+                # The results a dead worker delivered still hold their slots.
+                for message in pool.collect(0, sweep=sweep):
+                    handle(message, item_update, detailed)
+            for worker in dead:
+                tasks, running[worker] = running[worker], []
+                assigned[worker] = None
+                ring.reclaim(worker)
+                print("[Main] Worker-%d died with %d tasks in flight" % (worker, len(tasks)))
+                for task in tasks:
+                    give_up(task, "The worker died", item_update, detailed)
+
+            restart = [worker for worker in dead if worker in delivered]
+            if restart:
+                pool.start()
+                for worker in restart:
+                    delivered.discard(worker)
+                    assigned[worker] = 0
+                    pool.send(worker, ("sweep", sweep, references, self.backend, self.sample, bounds, operators))
+                    dispatch(worker)
+
+            if any(pool.is_alive(worker) for worker in pool.workers):
+                return
+            while len(scheduler):
+                for task in scheduler.clear():
+                    give_up(task, "No worker is left", item_update, detailed)
+
+        def notify(item_update, detailed, record):
+            if detailed:
+                item_update(record)
+            else:
+                item_update(record.tester, record.width, record.height, record.frame, record.score, record.image)
+
+        def handle_cached(task, item_update, detailed):
+            tester, width, height, frame = task
+            result, channels = cached[task]
+            completed[task] = (result, channels)
+            stats["results"] += 1
+            stats["cached"] += 1
+            improve((tester, frame), result)
+
+            notify(item_update, detailed, Result(
+                tester, width, height, frame, result, channels, None, None, None, None
+            ))
+            advance(tester, height, frame, result)
+
+        def record(worker, tester, width, height, frame, result, channels, r_time, task_timings, image,
+                   item_update, detailed, interval=None):
+            task_timings["queue"] = max(0.0, time.time() - r_time)
+            timings.add(tester, width, height, task_timings)
+            self.print_result(tester, width, height, frame, result, r_time-starttime, worker)
+            stats["results"] += 1
+
+            if interval is None:
+                completed[(tester, width, height, frame)] = (result, channels)
+                improve((tester, frame), result)
+                # Only exact scores are stored, a later sweep may sample or prune differently.
+                if self.store is not None:
+                    self.store.add(script, params[tester], tester, width, height, frame, result, channels)
+            elif interval[1] is None:
+                approximate.add((tester, width, height, frame))
+                pruned.add((tester, width, height, frame))
+                stats["pruned"] += 1
+            else:
+                approximate.add((tester, width, height, frame))
+                stats["estimated"] += 1
+
+            notify(item_update, detailed, Result(
+                tester, width, height, frame, result, channels, r_time-starttime, worker, image, interval
+            ))
+
+            # The lower bound of a pruned comparison would put a false slope into the curve.
+            advance(tester, height, frame, None if interval is not None and interval[1] is None else result)
+
+            key = (tester, frame)
+            if key in held:
+                held[key][0].discard((tester, width, height, frame))
+                if not held[key][0]:
+                    release(key, item_update, detailed)
+
+        def resolve(key, item_update, detailed):
+            """
+            Shortlists the sampled heights of a tester and frame once all of
+            them are estimated. The shortlist is compared in full, the other
+            estimates are reported as they are.
+            """
+            group = estimates.pop(key, None)
+            if not group:
+                return
+            heights = shortlist(
+                dict((task[2], (value[1], value[3])) for task, value in group.items()), self.threshold, best.get(key)
+            )
+            full = [task for task in sorted(group) if task[2] in heights]
+            exact.update(full)
+            scheduler.add(full)
+
+            held[key] = (set(full), group)
+            if not full:
+                release(key, item_update, detailed)
+            for other in list(assigned):
+                dispatch(other)
+
+        def release(key, item_update, detailed):
+            """
+            Reports the held estimates of a tester and frame. All heights are
+            measured on the same pixels, so the estimates share most of their
+            error. They are scaled by the ratio of the exact to the estimated
+            squared errors of the shortlist to line up with its exact scores.
+            """
+            _, group = held.pop(key)
+            compared = [task for task in group if task in exact and task in completed]
+            estimated = sum(group[task][1]**2 for task in compared)
+            if estimated > 0:
+                ratios[key] = sum(completed[task][0]**2 for task in compared) / estimated
+            scale = ratios.get(key, 1.0) ** .5
+
+            for (tester, width, height, frame), value in sorted(group.items()):
+                if (tester, width, height, frame) in exact and (tester, width, height, frame) not in failed:
+                    continue
+                worker, result, channels, interval, r_time, task_timings = value
+                record(worker, tester, width, height, frame, result * scale, tuple(c * scale for c in channels),
+                       r_time, task_timings, None, item_update, detailed, (interval[0] * scale, interval[1] * scale))
+
+        def handle(message, item_update, detailed):
+            type, worker, _, data = message
 
             if type == "message":
                 print("[Worker-%d] %s" % (worker, data))
 
             elif type == "result":
-                tester, width, height, frame, result, image, r_time = data
-                self.print_result(tester, width, height, frame, result, r_time-starttime, worker)
-                item_update(tester, width, height, frame, result, image)
-
-            elif type == "restart":
-                print("[Main] Restarting worker %d" % worker)
-                if worker in running_workers:
-                    running_workers[worker].terminate()
-
-                out_queue = SimpleQueue()
-                new_worker = multiprocessing.Process(
-                    target=ScaleWorker.start,
-                    args=(
-                        worker, self.avsfile, self.fstep, in_queue, out_queue
-                    )
+                tester, width, height, frame, result, channels, slot, r_time, task_timings = data
+                if not take(worker, (tester, width, height, frame)):
+                    ring.release(slot)
+                    return
+                image = ring.get(slot)
+                try:
+                    record(worker, tester, width, height, frame, result, channels, r_time, task_timings, image,
+                           item_update, detailed)
+                finally:
+                    image.release()
+                dispatch(worker)
+
+            elif type == "batch":
+                for tester, width, height, frame, result, channels, r_time, task_timings in data:
+                    if not take(worker, (tester, width, height, frame)):
+                        continue
+                    record(worker, tester, width, height, frame, result, channels, r_time, task_timings, None,
+                           item_update, detailed)
+                dispatch(worker)
+
+            elif type == "pruned":
+                tester, width, height, frame, result, channels, r_time, task_timings = data
+                if not take(worker, (tester, width, height, frame)):
+                    return
+                record(worker, tester, width, height, frame, result, channels, r_time, task_timings, None,
+                       item_update, detailed, (result, None))
+                dispatch(worker)
+
+            elif type == "sampled":
+                tester, width, height, frame, result, channels, interval, r_time, task_timings = data
+                if not take(worker, (tester, width, height, frame)):
+                    return
+                key = (tester, frame)
+                estimates.setdefault(key, {})[(tester, width, height, frame)] = (
+                    worker, result, channels, interval, r_time, task_timings
                 )
-                new_worker.daemon = True
-                running_workers[worker] = new_worker
-                queues.append(out_queue)
-                workers.append(new_worker)
-                new_worker.start()
+                outstanding[key] -= 1
+                if not outstanding[key]:
+                    resolve(key, item_update, detailed)
+                dispatch(worker)
+
+            elif type == "failed":
+                tester, width, height, frame, error = data
+                if take(worker, (tester, width, height, frame)):
+                    give_up((tester, width, height, frame), error, item_update, detailed)
+                dispatch(worker)
 
+            elif type == "idle":
+                print("[Worker-%d] Clip cache: %s" % (worker, data))
+                finished.add(worker)
+
+        def test_loopcb(item_update, timeout=0, max_batch=256, detailed=False):
+            """
+            Handles all messages that are ready, waiting up to timeout seconds
+            for the first one. Returns False once the sweep is complete or stopped.
+
+            :param detailed:  Call item_update with a single Result instead of
+                              (tester, width, height, frame, result, image).
+            """
+            if cancelled[0]:
+                return False
+            recover(item_update, detailed)
+            if done():
+                return False
+
+            count = 0
+            while replay and count < max_batch:
+                handle_cached(replay.popleft(), item_update, detailed)
+                count += 1
+            if count:
+                timeout = 0
+
+            messages = pool.collect(timeout, max_batch, sweep)
+            for message in messages:
+                handle(message, item_update, detailed)
+            recover(item_update, detailed)
+
+            if messages:
+                stats["batches"] += 1
+                stats["peak_batch"] = max(stats["peak_batch"], len(messages))
+            stats["throughput"] = stats["results"] / max(time.time()-starttime, 1e-6)
+            stats["planned"] = len(planned)
+            stats["pending"] = len(scheduler)
+            stats["in_flight"] = sum(count for count in assigned.values() if count)
+
+            if done():
+                references.close()
+                if bounds is not None:
+                    bounds.close()
+                if self.store is not None:
+                    self.store.flush()
+                save_checkpoint()
+                if not private:
+                    pool.release(sweep)
+                print("[Main] Locality: %s" % scheduler)
+                if len(timings):
+                    print("[Main] Phase timings:\n%s" % timings.summary())
+                if self.profile is not None:
+                    print("[Main] Worker profile (%s):\n%s" % (self.profile_dir, profile_report(self.profile_dir)))
+                print("[Main] %(results)d results, %(throughput).2f/s, peak batch %(peak_batch)d" % stats)
+                if self.sample is not None:
+                    print("[Main] %(estimated)d results estimated from samples" % stats)
+                if self.prune is not None:
+                    print("[Main] %(pruned)d comparisons stopped early" % stats)
+                if failed:
+                    print("[Main] %(failed)d tasks given up" % stats)
+                return False
+
+            if self.checkpoint is not None and self.checkpoint.due():
+                save_checkpoint()
             return True
 
         def stop():
-            for worker in workers:
-                worker.terminate()
+            """
+            Cancels the sweep. Tasks that have not been started are dropped,
+            tasks that are being rendered finish without reporting.
+            """
+            if cancelled[0]:
+                return
+            cancelled[0] = True
+
+            scheduler.clear()
+            pool.cancel(sweep)
+            references.close()
+            if bounds is not None:
+                bounds.close()
+            if self.store is not None:
+                self.store.flush()
+            save_checkpoint()
+            if private:
+                pool.shutdown()
+            else:
+                pool.release(sweep)
 
-        _data.next_obj = next(vals, None)
         return test_loopcb, stop
 
+    def stream(self, timeout=None, images=False, poll=.5):
+        """
+        Runs a sweep and yields a Result for every comparison as it completes.
+
+        The sweep is stopped when the generator is closed, so it is safe to
+        break out of a loop over it.
+
+        :param timeout:  Raise ResultTimeout if no result arrives for this many seconds.
+        :param images:   Attach a PIL copy of every scaled frame.
+        :param poll:     The longest time to block before checking for timeouts.
+        """
+        loopcb, stop = self.test()
+        ready = deque()
+
+        def collect(record):
+            if record.image is not None:
+                record = record._replace(image=record.image.to_image() if images else None)
+            ready.append(record)
+
+        try:
+            running = True
+            last = time.time()
+            while True:
+                while ready:
+                    yield ready.popleft()
+                    last = time.time()
+
+                if not running:
+                    break
+
+                wait = poll
+                if timeout is not None:
+                    left = last + timeout - time.time()
+                    if left <= 0:
+                        raise ResultTimeout("No result within %g seconds." % timeout)
+                    wait = min(poll, left)
+                running = loopcb(collect, timeout=wait, detailed=True)
+        finally:
+            stop()
+
     def print_result(self, t, w, h, f, p, c, n):
         print "[Result] %s\t%dx%d\t%d\t%.4f%%\t%.2fsecs\tWorker-%d"%(t, w, h, f, p*100, c, n)
\ No newline at end of file
@@ -1,187 +1,299 @@
 """
+Detects the native resolution of one or more scripts without a GUI.
+
 Usage:
-    hallo.py SRC FRAMES HEIGHTS
+    detect.py node [options] ADDRESS
+    detect.py [options] SRC...
+
+Arguments:
+    SRC                     AviSynth scripts or glob patterns matching them.
+    ADDRESS                 HOST:PORT of a coordinator started with --listen.
+
+Options:
+    --frames=FRAMES         Frames to test as start:stop[:step]. [default: 0:1]
+    --heights=HEIGHTS       Heights to test as start:stop[:step]. [default: 400:1081:2]
+    --aspect-ratio=AR       Aspect ratio of the tested resolutions. [default: 16:9]
+    --cpus=N                Number of workers. Defaults to one per CPU.
+    --mode=MODE             Run the workers as "process"es or "thread"s. [default: process]
+    --search=MODE           "full" or "adaptive". [default: full]
+    --threshold=T           Modified z-score threshold of the dip detection. [default: 5]
+    --backend=NAME          Descale with "avisynth" plugins or "numpy". [default: avisynth]
+    --batch                 Score whole runs of heights in one pass. Needs the
+                            numpy backend.
+    --luma                  Compare the luma plane instead of RGB frames.
+    --sample=SPEC           Estimate the errors from "grid:STEP" (every STEP-th
+                            row and column) or "tiles:FRACTION[:SIZE]" (detail
+                            weighted tiles) of every frame and compare only the
+                            shortlisted heights in full.
+    --prune=MARGIN          Stop comparisons once their error exceeds the best
+                            of their tester and frame by this relative margin,
+                            e.g. 1. Stopped candidates report a lower bound
+                            close to the margin, so a margin smaller than the
+                            depth of a dip can hide it.
+    --format=FORMAT         "json" or "csv". [default: json]
+    -o PATH --output=PATH   Write the report to PATH instead of stdout.
+    --no-cache              Do not read or write the result store.
+    --timeout=SECONDS       Give up on a script if no result arrives for this long.
+    --profile=MODE          Profile the workers with "cprofile" or "sample".
+    --profile-dir=DIR       Directory for the worker profiles.
+    --listen=ADDRESS        Serve the sweeps to remote nodes on [HOST]:PORT
+                            instead of starting local workers.
+    --lease=SECONDS         Time after which unfinished tasks of a node are
+                            handed to other nodes. [default: 60]
+    --authkey=KEY           Secret shared by the coordinator and its nodes.
+                            Defaults to $BLURES_AUTHKEY.
+    --script=PATH           Local path of the script on a node. Defaults to
+                            the path used by the coordinator.
+
+The sweep log is written to stderr. The exit code is 1 if any script
+failed and 2 if no script matched.
 """
 import os
-import time
-import threading
-
-os.environ["TCL_LIBRARY"] = "C:\\Python27\\tcl\\tcl8.5"
-
-from matplotlib import pyplot
+import sys
+import csv
+import glob
+import json
+import traceback
 
 import docopt
 
-from blures.worker import Executor
+from blures.worker import Executor, ResultTimeout
 from blures.testers import Tester
+from blures.compare import parse_sample
+from blures.detection import detect, slopes
+from blures.store import ResultStore
+from blures.distributed import Coordinator, parse_address, run_node
+
+
+class SweepFailed(Exception):
+    pass
+
+
+def parse_range(value):
+    return range(*(int(i) for i in value.split(":")))
+
+
+def find_sources(patterns):
+    """
+    Expands the glob patterns. Patterns without wildcards are kept as-is so
+    missing files are reported as failures.
+    """
+    sources = []
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            sources.extend(sorted(glob.glob(pattern)))
+        else:
+            sources.append(pattern)
+    return sources
+
+
+def sweep(src, hstep, fstep, options, store):
+    """
+    Runs a sweep over a single script.
+
+    :return: A dictionary mapping tester names to {height: [errors of each frame]}
+             and the phase timings of the sweep or None.
+    """
+    if not os.path.isfile(src):
+        raise SweepFailed("No such file: %s" % src)
+
+    if options["listen"]:
+        app = Coordinator(
+            src, hstep, fstep, aspect_ratio=options["aspect_ratio"], address=options["listen"],
+            authkey=options["authkey"], lease_time=options["lease"], search=options["search"],
+            threshold=options["threshold"], store=store, backend=options["backend"], luma=options["luma"]
+        )
+    else:
+        app = Executor(
+            src, hstep, fstep, aspect_ratio=options["aspect_ratio"], cpus=options["cpus"],
+            search=options["search"], threshold=options["threshold"], store=store, mode=options["mode"],
+            profile=options["profile"], profile_dir=options["profile_dir"], backend=options["backend"],
+            batch=options["batch"], luma=options["luma"], sample=options["sample"],
+            prune=options["prune"]
+        )
+
+    scores = dict((name, {}) for name in app.testers)
+    for record in app.stream(timeout=options["timeout"]):
+        scores[record.tester].setdefault(record.height, []).append(record.score)
+
+    if app.stats["results"] < app.stats["planned"]:
+        raise SweepFailed("Only %d of %d tasks completed." % (app.stats["results"], app.stats["planned"]))
+    return scores, getattr(app, "timings", None)
+
+
+def analyse(scores, threshold):
+    """
+    Averages the errors of all frames and detects the dips of every tester.
+    """
+    testers = {}
+    for name, results in sorted(scores.items()):
+        heights = sorted(results)
+        errors = [sum(results[h]) / len(results[h]) for h in heights]
+
+        steps, deltas = slopes(heights, errors)
+        candidates = []
+        if len(deltas) > 2:
+            candidates = sorted(set(detect(steps, deltas, threshold)))
+
+        testers[name] = {
+            "heights": heights,
+            "errors": errors,
+            "candidates": candidates,
+        }
+    return testers
+
+
+def write_json(reports, f):
+    json.dump(reports, f, indent=2, sort_keys=True)
+    f.write("\n")
+
+
+def write_csv(reports, f):
+    writer = csv.writer(f)
+    writer.writerow(["source", "status", "tester", "height", "error", "candidate"])
+    for report in reports:
+        if report["status"] != "ok":
+            writer.writerow([report["source"], report["status"], "", "", "", ""])
+            continue
+
+        for name, tester in sorted(report["testers"].items()):
+            candidates = set(tester["candidates"])
+            for height, error in zip(tester["heights"], tester["errors"]):
+                writer.writerow([report["source"], "ok", name, height, repr(error), int(height in candidates)])
+
+
+WRITERS = {
+    "json": write_json,
+    "csv": write_csv,
+}
+
+
+def node(vars):
+    """
+    Works for a coordinator until its sweep is finished.
+    """
+    try:
+        address = parse_address(vars["ADDRESS"])
+        cpus = int(vars["--cpus"]) if vars["--cpus"] else None
+    except ValueError:
+        sys.stderr.write("Invalid address or cpu count.\n")
+        return 2
+
+    authkey = vars["--authkey"] or os.environ.get("BLURES_AUTHKEY")
+    if not authkey:
+        sys.stderr.write("Nodes need the --authkey of the coordinator.\n")
+        return 2
+
+    if run_node(address, authkey, cpus, vars["--script"]):
+        return 1
+    return 0
+
+
+def run(argv=None):
+    vars = docopt.docopt(__doc__, argv)
+    if vars["node"]:
+        return node(vars)
+
+    try:
+        fstep = parse_range(vars["--frames"])
+        hstep = parse_range(vars["--heights"])
+        aspect_ratio = tuple(int(a) for a in vars["--aspect-ratio"].split(":"))
+        options = {
+            "aspect_ratio": aspect_ratio,
+            "cpus": int(vars["--cpus"]) if vars["--cpus"] else None,
+            "search": vars["--search"],
+            "mode": vars["--mode"],
+            "backend": vars["--backend"],
+            "batch": vars["--batch"],
+            "luma": vars["--luma"],
+            "sample": vars["--sample"],
+            "prune": float(vars["--prune"]) if vars["--prune"] else None,
+            "timeout": float(vars["--timeout"]) if vars["--timeout"] else None,
+            "profile": vars["--profile"],
+            "profile_dir": vars["--profile-dir"],
+            "threshold": float(vars["--threshold"]),
+            "listen": parse_address(vars["--listen"]) if vars["--listen"] else None,
+            "lease": float(vars["--lease"]),
+            "authkey": vars["--authkey"] or os.environ.get("BLURES_AUTHKEY"),
+        }
+    except (ValueError, TypeError):
+        sys.stderr.write("Invalid frame range, height range, aspect ratio, cpu count, threshold, address, lease "
+                         "or margin.\n")
+        return 2
+
+    if options["listen"] and not options["authkey"]:
+        sys.stderr.write("--listen needs an --authkey.\n")
+        return 2
+
+    if options["batch"] and (options["backend"] != "numpy" or options["listen"]):
+        sys.stderr.write("--batch needs the numpy backend and local workers.\n")
+        return 2
+
+    if options["sample"]:
+        try:
+            parse_sample(options["sample"])
+        except ValueError as e:
+            sys.stderr.write("%s\n" % e)
+            return 2
+        if options["batch"] or options["listen"]:
+            sys.stderr.write("--sample needs local workers and cannot be combined with --batch.\n")
+            return 2
+
+    if options["prune"] is not None and (options["prune"] < 0 or options["batch"] or options["listen"]):
+        sys.stderr.write("--prune needs a margin of at least 0 and local workers, and cannot be combined "
+                         "with --batch.\n")
+        return 2
+
+    if len(aspect_ratio) != 2 or options["search"] not in ("full", "adaptive") or vars["--format"] not in WRITERS \
+            or options["mode"] not in ("process", "thread") or options["backend"] not in Tester.backends \
+            or options["profile"] not in (None, "cprofile", "sample"):
+        sys.stderr.write(__doc__)
+        return 2
+
+    sources = find_sources(vars["SRC"])
+    if not sources:
+        sys.stderr.write("No scripts matched.\n")
+        return 2
+
+    # The executor logs its progress on stdout.
+    stdout, sys.stdout = sys.stdout, sys.stderr
+
+    store = None if vars["--no-cache"] else ResultStore()
+    reports = []
+    try:
+        for src in sources:
+            report = {"source": src}
+            try:
+                scores, timings = sweep(src, hstep, fstep, options, store)
+                report["testers"] = analyse(scores, options["threshold"])
+                if timings is not None and len(timings):
+                    report["timings"] = timings.to_dict()
+                report["status"] = "ok"
+                for name, tester in sorted(report["testers"].items()):
+                    for height in tester["candidates"]:
+                        print("Possible interesting point at height: %d@%s in %s" % (height, name, src))
+            except Exception as e:
+                if not isinstance(e, (SweepFailed, ResultTimeout)):
+                    traceback.print_exc()
+                print("[Main] %s failed: %s" % (src, e))
+                report["status"] = "failed"
+                report["error"] = str(e) or e.__class__.__name__
+            reports.append(report)
+    finally:
+        if store is not None:
+            store.close()
+        sys.stdout = stdout
+
+    if vars["--output"]:
+        with open(vars["--output"], "wb" if vars["--format"] == "csv" else "w") as f:
+            WRITERS[vars["--format"]](reports, f)
+    else:
+        WRITERS[vars["--format"]](reports, sys.stdout)
+
+    if any(report["status"] != "ok" for report in reports):
+        return 1
+    return 0
 
 
-def run():
-    vars = docopt.docopt(__doc__)
-
-    fstep = range(*(int(i) for i in vars["FRAMES"].split(":")))
-    hstep = range(*(int(i) for i in vars["HEIGHTS"].split(":")))
-    src = vars["SRC"]
-
-    app = Executor(src, hstep, fstep)
-    cb, stop = app.test()
-
-    class _data(object):
-        testers = {}
-        res_before = {}
-        lock = threading.Lock()
-
-        @classmethod
-        def init(cls):
-            for name, tester in Tester.testers.items():
-                data = [[], [], []]
-                cls.testers[name] = data
-
-            plots, names = [],[]
-            for name, tester in Tester.testers.items():
-                pyplot.subplot(211)
-                plt = pyplot.scatter([], [], color=tester.color)
-                plots.append(plt)
-                names.append(name)
-                pyplot.grid()
-                pyplot.legend(plots, names, loc='upper left', bbox_to_anchor=(0, 1))
-
-            plots, names = [],[]
-            for name, tester in Tester.testers.items():
-                pyplot.subplot(212)
-                plt = pyplot.scatter([], [], color=tester.color)
-                plots.append(plt)
-                names.append(name)
-                pyplot.grid()
-                pyplot.legend(plots, names, loc='upper left', bbox_to_anchor=(0, 1))
-
-        @classmethod
-        def on_new_item(cls, tester, width, height, frame, result, image):
-            if tester not in cls.res_before:
-                cls.res_before[tester] = result
-                return
-
-            diff = result - cls.res_before[tester]
-
-            heights, results, actual = cls.testers[tester]
-            with cls.lock:
-                heights.append(height)
-                results.append(diff)
-                actual.append(result)
-
-            cls.res_before[tester] = result
-
-    def datathread():
-        while cb(_data.on_new_item):
-            pass
-
-    _data.init()
-
-    thread = threading.Thread(target=datathread)
-    thread.daemon = True
-    thread.start()
-
-    def _update():
-        pyplot.subplot(211)
-        plots, names = [], []
-        for name, tester in Tester.testers.items():
-            with _data.lock:
-                heights, delta, results = _data.testers[name]
-                plt = pyplot.scatter(heights, delta, color=tester.color, marker="x")
-            plots.append(plt)
-            names.append(name)
-
-
-        pyplot.title("Resolution Rescaling Image Comparison [d/dx]")
-        pyplot.legend(plots, names, loc='upper left', bbox_to_anchor=(0, 1))
-
-        pyplot.subplot(212)
-        plots, names = [], []
-        for name, tester in Tester.testers.items():
-            with _data.lock:
-                heights, delta, results = _data.testers[name]
-                plt = pyplot.scatter(heights, results, color=tester.color)
-            plots.append(plt)
-            names.append(name)
-
-        pyplot.title("Resolution Rescaling Image Comparison")
-        pyplot.legend(plots, names, loc='upper left', bbox_to_anchor=(0, 1))
-
-        pyplot.draw()
-
-    pyplot.subplot(211)
-    pyplot.grid()
-    pyplot.subplot(212)
-    pyplot.grid()
-
-    tstart = time.time()
-    while thread.is_alive():
-        if time.time()-tstart > 5:
-            _update()
-            tstart = time.time()
-
-        pyplot.pause(.5)
-    _update()
-    stop()
-
-    import numpy as np
-
-    def is_outlier(points, thresh=5):
-        """
-        Returns a boolean array with True if points are outliers and False
-        otherwise.
-
-        Parameters:
-        -----------
-            points : An numobservations by numdimensions array of observations
-            thresh : The modified z-score to use as a threshold. Observations with
-                a modified z-score (based on the median absolute deviation) greater
-                than this value will be classified as outliers.
-
-        Returns:
-        --------
-            mask : A numobservations-length boolean array.
-
-        References:
-        ----------
-            Boris Iglewicz and David Hoaglin (1993), "Volume 16: How to Detect and
-            Handle Outliers", The ASQC Basic References in Quality Control:
-            Statistical Techniques, Edward F. Mykytka, Ph.D., Editor.
-        """
-        if len(points.shape) == 1:
-            points = points[:,None]
-        median = np.median(points, axis=0)
-        diff = np.sum((points - median)**2, axis=-1)
-        diff = np.sqrt(diff)
-        med_abs_deviation = np.median(diff)
-
-        modified_z_score = 0.6745 * diff / med_abs_deviation
-
-        return modified_z_score > thresh
-
-    for name, tester in Tester.testers.items():
-        heights, results, _ = _data.testers[name]
-        results = np.array(results)
-        mask = is_outlier(results)
-        outliers = np.array([results, np.arange(len(results), dtype=np.uint16)]).T[mask]
-        ibefore = None
-        for val, i in outliers:
-            if ibefore is None:
-                ibefore = (i, val)
-                continue
-
-            if i - ibefore[0] > 1:
-                ibefore = (i, val)
-                continue
-
-            if ibefore[1] < 0:
-                ibefore = (i, val)
-                continue
-
-            print("Possible interesting point at height: %d@%s" % (heights[int(ibefore[0])], name))
-            ibefore = (i, val)
-
-    pyplot.show()
-
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    sys.exit(run())
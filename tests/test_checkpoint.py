@@ -0,0 +1,51 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from blures import synthetic
+from blures.checkpoint import Checkpoint
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        synthetic.install()
+        self.directory = tempfile.mkdtemp()
+        self.script = synthetic.write_script(os.path.join(self.directory, "source.avs"), 100, (128, 72), 1)
+        self.path = os.path.join(self.directory, "checkpoint.json")
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        shutil.rmtree(self.directory)
+
+    def test_resume_submits_pending(self):
+        from blures.worker import Executor
+
+        executor = Executor(self.script, [90, 100], [0], cpus=1, mode="thread", checkpoint=self.path)
+        first = list(executor.stream(timeout=60))
+        config, results, pending, complete = Checkpoint(self.path).load()
+        self.assertTrue(complete)
+        self.assertEqual(len(results), len(first))
+
+        # A refinement that was planned but not compared when the sweep stopped.
+        refinement = ("bicubic", Executor.get_resolution(96)[0], 96, 0)
+        Checkpoint(self.path).save(config, results, [refinement])
+
+        resumed = list(Executor.resume(self.path).stream(timeout=60))
+        tasks = set((record.tester, record.width, record.height, record.frame) for record in resumed)
+        self.assertIn(refinement, tasks)
+        self.assertEqual(len(resumed), len(first) + 1)
+
+        config, results, pending, complete = Checkpoint(self.path).load()
+        self.assertIn(refinement, results)
+        self.assertEqual(pending, [])
+        self.assertTrue(complete)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import Queue
+import unittest
+
+from blures.pool import ThreadPool
+
+
+class SharedPoolTest(unittest.TestCase):
+
+    def tearDown(self):
+        ThreadPool.shutdown_all()
+
+    def test_claimed_pool_is_not_shared(self):
+        pool = ThreadPool.shared("missing.avs", 2, (64, 36))
+        sweep = pool.claim()
+        self.assertIsNotNone(sweep)
+        self.assertIs(ThreadPool.shared("missing.avs", 2, (64, 36)), pool)
+        self.assertIsNone(pool.claim())
+
+        pool.release(sweep)
+        self.assertEqual(pool.claim(), sweep + 1)
+
+    def test_config_change_waits_for_sweep(self):
+        pool = ThreadPool.shared("missing.avs", 2, (64, 36))
+        sweep = pool.claim()
+        pool.results = Queue.Queue()
+
+        other = ThreadPool.shared("missing.avs", 4, (64, 36))
+        self.assertIsNot(other, pool)
+        self.assertIsNotNone(pool.results)
+
+        pool.release(sweep)
+        self.assertIsNone(pool.results)
+        self.assertIs(ThreadPool.shared("missing.avs", 4, (64, 36)), other)
+
+    def test_collect_routes_by_sweep(self):
+        pool = ThreadPool("missing.avs", 1, (64, 36))
+        pool.results = Queue.Queue()
+        sweep = pool.claim()
+        pool.results.put(("batch", 0, sweep - 1, []))
+        pool.results.put(("message", 0, None, "Loading"))
+        pool.results.put(("batch", 0, sweep, []))
+
+        messages = pool.collect(0, sweep=sweep)
+        self.assertEqual([message[0] for message in messages], ["message", "batch"])
+        self.assertEqual(messages[1][2], sweep)
+
+
+if __name__ == "__main__":
+    unittest.main()
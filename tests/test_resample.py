@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from blures.resample import AxisRescaler, apply_banded, axis_rescaler, banded, bicubic, bilinear, operator_dir, \
+    upscale_matrix
+
+
+class AxisRescalerTest(unittest.TestCase):
+
+    sizes = [(5, 7), (31, 32), (33, 64), (100, 101), (281, 360), (540, 1080)]
+
+    def test_descale_is_least_squares(self):
+        random = np.random.RandomState(0)
+        for kernel in (bilinear, bicubic(), bicubic(0, .5)):
+            for native, size in self.sizes:
+                data = random.randint(0, 256, (size, 6)).astype(np.float32)
+                matrix = upscale_matrix(kernel, native, size)
+                expected = np.linalg.lstsq(matrix, data.astype(np.float64), rcond=-1)[0]
+
+                rescaler = AxisRescaler(kernel, native, size)
+                self.assertLess(abs(rescaler.descale(data) - expected).max(), 1e-2)
+                energy = (matrix.dot(expected)**2).sum()
+                self.assertAlmostEqual((rescaler.coefficients(data)**2).sum() / energy, 1, places=4)
+
+    def test_apply_banded(self):
+        matrix = upscale_matrix(bicubic(), 281, 360)
+        data = np.random.RandomState(1).rand(281, 4).astype(np.float32)
+        indices, weights = banded(matrix)
+        self.assertLess(abs(apply_banded((indices, weights), data) - matrix.dot(data)).max(), 1e-4)
+
+        rows = np.arange(3, 360, 37)
+        self.assertLess(abs(apply_banded((indices[rows], weights[rows]), data) - matrix[rows].dot(data)).max(), 1e-4)
+
+    def test_save_load(self):
+        rescaler = AxisRescaler(bicubic(), 281, 360)
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "operator.npz")
+        try:
+            rescaler.save(path)
+            loaded = AxisRescaler.load(path, 281, 360)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rmdir(directory)
+
+        data = np.random.RandomState(2).rand(360, 3).astype(np.float32)
+        np.testing.assert_array_equal(loaded.rescale(data), rescaler.rescale(data))
+
+    def test_operators_are_stored_per_user(self):
+        directory = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        os.environ.pop("LOCALAPPDATA", None)
+        os.environ["XDG_CACHE_HOME"] = directory
+        try:
+            axis_rescaler(("test_operators_are_stored_per_user",), bicubic(), 281, 360)
+            self.assertTrue(operator_dir().startswith(directory))
+            self.assertEqual(len(os.listdir(operator_dir())), 1)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    unittest.main()
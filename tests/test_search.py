@@ -0,0 +1,76 @@
+import unittest
+
+import numpy as np
+
+from blures.search import AdaptiveSearch
+
+
+def jagged(heights, native, seed):
+    """
+    Returns an error curve per frame: a falling trend with jagged noise and
+    a single height wide dip at the native height.
+    """
+    random = np.random.RandomState(seed)
+    curve = {}
+    for height in heights:
+        error = 0.02 - 0.00002 * height + random.normal(0, 0.0008)
+        if height == native:
+            error *= 0.2
+        curve[height] = error
+    return curve
+
+
+def run(search, testers, frames, curves):
+    tested = []
+    queue = list(search.start(testers, frames))
+    while queue:
+        tester, height, frame = queue.pop(0)
+        tested.append((tester, height, frame))
+        queue.extend(search.add(tester, height, frame, curves[(tester, frame)][height]))
+    return tested
+
+
+class AdaptiveSearchTest(unittest.TestCase):
+
+    heights = list(range(400, 1101, 2))
+    testers = ["bilinear", "bicubic", "spline36"]
+    frames = [0, 1, 2]
+
+    def curves(self, native, seed=0):
+        return dict(
+            ((tester, frame), jagged(self.heights, native, seed + 10*i + frame))
+            for i, tester in enumerate(self.testers) for frame in self.frames
+        )
+
+    def test_budget(self):
+        full = len(self.heights) * len(self.testers) * len(self.frames)
+        for seed in range(10):
+            search = AdaptiveSearch(self.heights)
+            tested = run(search, self.testers, self.frames, self.curves(self.heights[37 + seed*29], seed))
+            self.assertTrue(search.finished())
+            self.assertEqual(len(tested), len(set(tested)))
+            self.assertLess(len(tested), 0.25 * full)
+
+    def test_refines_dip(self):
+        search = AdaptiveSearch(self.heights)
+        native = AdaptiveSearch(self.heights).grid(1, len(self.testers))[20]
+        tested = run(search, self.testers, self.frames, self.curves(native))
+        for frame in self.frames:
+            self.assertIn(("bicubic", native - 2, frame), tested)
+            self.assertIn(("bicubic", native + 2, frame), tested)
+
+    def test_skip(self):
+        search = AdaptiveSearch(self.heights)
+        curves = self.curves(600)
+        queue = list(search.start(self.testers, self.frames))
+        while queue:
+            tester, height, frame = queue.pop(0)
+            if height == 500:
+                queue.extend(search.skip(tester, height, frame))
+            else:
+                queue.extend(search.add(tester, height, frame, curves[(tester, frame)][height]))
+        self.assertTrue(search.finished())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,26 @@
+import unittest
+
+from blures.testers import NumpyTester, Tester
+
+
+class NumpyTesterTest(unittest.TestCase):
+
+    def test_registered_testers_have_kernels(self):
+        self.assertTrue(Tester.backends["numpy"])
+        for name, tester in Tester.backends["numpy"].items():
+            kernel = tester.kernel()
+            self.assertTrue(callable(kernel), name)
+            self.assertGreater(kernel.support, 0, name)
+            self.assertEqual(float(kernel(float(kernel.support))), 0., name)
+
+    def test_tester_without_kernel_is_not_registered(self):
+        class MissingKernelTester(NumpyTester):
+            pass
+
+        with self.assertRaises(TypeError):
+            Tester.tester("missing", "black")(MissingKernelTester)
+        self.assertNotIn("missing", Tester.backends["numpy"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import Queue
+import pickle
+import unittest
+import multiprocessing
+
+from blures.sharedmem import BestScores
+from blures.worker import ScaleWorker
+
+
+class BoundTest(unittest.TestCase):
+
+    def worker(self, best):
+        worker = ScaleWorker()
+        worker.no = 0
+        worker.sweep = 1
+        worker.cancelled = multiprocessing.Value("l", 0)
+        worker.out_queue = Queue.Queue()
+        worker.best = best
+        return worker
+
+    def test_bound(self):
+        best = BestScores([("bicubic", 0)], 0.5)
+        try:
+            best.update(("bicubic", 0), 0.01)
+            worker = self.worker(pickle.loads(pickle.dumps(best)))
+            self.assertAlmostEqual(worker.get_bound("bicubic", 0), 0.015)
+            self.assertIsNone(worker.get_bound("bilinear", 0))
+        finally:
+            best.close()
+
+    def test_unavailable_scores_disable_pruning(self):
+        best = BestScores([("bicubic", 0)], 0.5)
+        copy = pickle.loads(pickle.dumps(best))
+        best.close()
+
+        worker = self.worker(copy)
+        self.assertIsNone(worker.get_bound("bicubic", 0))
+        self.assertIsNone(worker.best)
+        self.assertEqual(worker.out_queue.get_nowait()[0], "message")
+
+
+if __name__ == "__main__":
+    unittest.main()